@@ -2,18 +2,74 @@
 图片压缩 API - 内存处理，不保存文件
 """
 from fastapi import APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import Response
-from typing import List
+from fastapi.responses import Response, StreamingResponse
+from typing import List, Optional, Tuple
 from pathlib import Path
-import io
+from urllib.parse import quote
+import asyncio
+import json
 import base64
+import uuid
 
-from app.core.compressor import AdvancedCompressor
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+from app.core import batcher
+from app.core.compressor import sniff_format
 from app.core.config import settings
 from app.models.schemas import CompressResult, BatchCompressResult
 
 router = APIRouter()
-compressor = AdvancedCompressor()
+
+_MIME_MAP = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'avif': 'image/avif'
+}
+_DATA_URL_PREFIX = {fmt: f"data:{mime};base64,".encode() for fmt, mime in _MIME_MAP.items()}
+
+
+def _data_url(target_format: str, data: bytes) -> str:
+    """拼接 data URL，前缀按格式预先计算，只做一次解码"""
+    prefix = _DATA_URL_PREFIX.get(target_format, _DATA_URL_PREFIX['png'])
+    return (prefix + base64.b64encode(data)).decode('ascii')
+
+
+def _ndjson_line(payload: dict) -> bytes:
+    """序列化一行 NDJSON，优先使用 orjson"""
+    if HAS_ORJSON:
+        return orjson.dumps(payload) + b"\n"
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode()
+
+
+def _precheck_upload(file: UploadFile) -> Optional[str]:
+    """读取前检查扩展名和声明的大小，返回错误信息，通过时返回 None"""
+    file_ext = Path(file.filename).suffix.lower()
+    if file_ext not in settings.ALLOWED_EXTENSIONS:
+        return f"不支持的格式: {file_ext}"
+    if file.size is not None and file.size > settings.MAX_FILE_SIZE:
+        return "文件过大"
+    return None
+
+
+def _postcheck_content(content: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """读取后检查大小并按文件头识别真实格式，返回 (格式, 错误信息)"""
+    if len(content) > settings.MAX_FILE_SIZE:
+        return None, "文件过大"
+    actual_format = sniff_format(content)
+    if actual_format is None:
+        return None, "无法识别的图片格式"
+    return actual_format, None
+
+
+async def _read_upload(file: UploadFile, semaphore: asyncio.Semaphore) -> bytes:
+    async with semaphore:
+        return await file.read()
 
 
 @router.post("/compress", response_model=CompressResult)
@@ -51,28 +107,22 @@ async def compress_single_image(
                 format=""
             )
 
-        input_buffer = io.BytesIO(content)
-        output_buffer = io.BytesIO()
-
-
-        target_format = output_format if output_format else file_ext[1:]
-        compressed_size, ratio = compressor.compress_in_memory(
-            input_buffer,
-            output_buffer,
-            target_format
-        )
-
-        output_buffer.seek(0)
-        base64_data = base64.b64encode(output_buffer.read()).decode('utf-8')
+        actual_format = sniff_format(content)
+        if actual_format is None:
+            return CompressResult(
+                filename=file.filename,
+                original_size=original_size,
+                compressed_size=0,
+                compression_ratio=0,
+                data="",
+                success=False,
+                error="无法识别的图片格式",
+                format=""
+            )
 
-        mime_map = {
-            'png': 'image/png',
-            'jpg': 'image/jpeg',
-            'jpeg': 'image/jpeg',
-            'webp': 'image/webp'
-        }
-        mime_type = mime_map.get(target_format, 'image/png')
-        data_url = f"data:{mime_type};base64,{base64_data}"
+        target_format = output_format if output_format else actual_format
+        compressed, compressed_size, ratio = await batcher.submit(content, target_format)
+        data_url = _data_url(target_format, compressed)
 
         return CompressResult(
             filename=file.filename,
@@ -103,100 +153,87 @@ async def compress_batch_images(files: List[UploadFile] = File(...)):
     if len(files) > settings.MAX_FILES_PER_BATCH:
         raise HTTPException(400, f"最多支持 {settings.MAX_FILES_PER_BATCH} 个文件")
 
-    results = []
-    total_original_size = 0
-    total_compressed_size = 0
-    success_count = 0
-    failed_count = 0
-
-    for file in files:
-        try:
-
-            file_ext = Path(file.filename).suffix.lower()
-            if file_ext not in settings.ALLOWED_EXTENSIONS:
-                results.append(CompressResult(
-                    filename=file.filename,
-                    original_size=0,
-                    compressed_size=0,
-                    compression_ratio=0,
-                    data="",
-                    success=False,
-                    error=f"不支持的格式: {file_ext}",
-                    format=""
-                ))
-                failed_count += 1
-                continue
-
-
-            content = await file.read()
-            original_size = len(content)
+    results: List[Optional[CompressResult]] = [None] * len(files)
+    pending = []
 
+    for index, file in enumerate(files):
+        error = _precheck_upload(file)
+        if error:
+            results[index] = CompressResult(
+                filename=file.filename,
+                original_size=file.size or 0,
+                compressed_size=0,
+                compression_ratio=0,
+                data="",
+                success=False,
+                error=error,
+                format=""
+            )
+            continue
 
-            if original_size > settings.MAX_FILE_SIZE:
-                results.append(CompressResult(
-                    filename=file.filename,
-                    original_size=original_size,
-                    compressed_size=0,
-                    compression_ratio=0,
-                    data="",
-                    success=False,
-                    error="文件过大",
-                    format=""
-                ))
-                failed_count += 1
-                continue
+        pending.append((index, file))
 
 
-            input_buffer = io.BytesIO(content)
-            output_buffer = io.BytesIO()
+    read_semaphore = asyncio.Semaphore(settings.MAX_CONCURRENT_READS)
+    contents = await asyncio.gather(*(_read_upload(file, read_semaphore) for _, file in pending))
 
-            target_format = file_ext[1:]
-            compressed_size, ratio = compressor.compress_in_memory(
-                input_buffer,
-                output_buffer,
-                target_format
+    jobs = []
+    for (index, file), content in zip(pending, contents):
+        actual_format, error = _postcheck_content(content)
+        if error:
+            results[index] = CompressResult(
+                filename=file.filename,
+                original_size=len(content),
+                compressed_size=0,
+                compression_ratio=0,
+                data="",
+                success=False,
+                error=error,
+                format=""
             )
+            continue
 
+        jobs.append((index, file.filename, content, actual_format))
 
-            output_buffer.seek(0)
-            base64_data = base64.b64encode(output_buffer.read()).decode('utf-8')
-
-
-            mime_map = {
-                'png': 'image/png',
-                'jpg': 'image/jpeg',
-                'jpeg': 'image/jpeg',
-                'webp': 'image/webp'
-            }
-            mime_type = mime_map.get(target_format, 'image/png')
-            data_url = f"data:{mime_type};base64,{base64_data}"
 
-            results.append(CompressResult(
-                filename=file.filename,
-                original_size=original_size,
-                compressed_size=compressed_size,
-                compression_ratio=ratio,
-                data=data_url,
-                success=True,
-                format=target_format
-            ))
+    outcomes = await asyncio.gather(
+        *(batcher.submit(content, target_format) for _, _, content, target_format in jobs),
+        return_exceptions=True
+    )
 
-            total_original_size += original_size
-            total_compressed_size += compressed_size
-            success_count += 1
+    total_original_size = 0
+    total_compressed_size = 0
+    success_count = 0
 
-        except Exception as e:
-            results.append(CompressResult(
-                filename=file.filename,
+    for (index, filename, content, target_format), outcome in zip(jobs, outcomes):
+        if isinstance(outcome, Exception):
+            results[index] = CompressResult(
+                filename=filename,
                 original_size=0,
                 compressed_size=0,
                 compression_ratio=0,
                 data="",
                 success=False,
-                error=str(e),
+                error=str(outcome),
                 format=""
-            ))
-            failed_count += 1
+            )
+            continue
+
+        compressed, compressed_size, ratio = outcome
+
+        results[index] = CompressResult(
+            filename=filename,
+            original_size=len(content),
+            compressed_size=compressed_size,
+            compression_ratio=ratio,
+            data=_data_url(target_format, compressed),
+            success=True,
+            format=target_format
+        )
+
+        total_original_size += len(content)
+        total_compressed_size += compressed_size
+        success_count += 1
 
 
     total_ratio = 0
@@ -206,9 +243,193 @@ async def compress_batch_images(files: List[UploadFile] = File(...)):
     return BatchCompressResult(
         total=len(files),
         success=success_count,
-        failed=failed_count,
+        failed=len(files) - success_count,
         results=results,
         total_original_size=total_original_size,
         total_compressed_size=total_compressed_size,
         total_compression_ratio=total_ratio
     )
+
+
+@router.post("/compress/raw")
+async def compress_single_image_raw(
+    file: UploadFile = File(...),
+    output_format: str = None
+):
+    """压缩单个图片，直接返回二进制图片，元数据放在响应头中"""
+    file_ext = Path(file.filename).suffix.lower()
+    if file_ext not in settings.ALLOWED_EXTENSIONS:
+        raise HTTPException(415, f"不支持的格式: {file_ext}")
+
+    content = await file.read()
+    original_size = len(content)
+    if original_size > settings.MAX_FILE_SIZE:
+        raise HTTPException(413, "文件过大")
+
+    actual_format = sniff_format(content)
+    if actual_format is None:
+        raise HTTPException(415, "无法识别的图片格式")
+
+    target_format = output_format if output_format else actual_format
+    try:
+        compressed, compressed_size, ratio = await batcher.submit(content, target_format)
+    except Exception as e:
+        raise HTTPException(500, str(e))
+
+    return Response(
+        content=compressed,
+        media_type=_MIME_MAP.get(target_format, 'image/png'),
+        headers={
+            "X-Original-Size": str(original_size),
+            "X-Compressed-Size": str(compressed_size),
+            "X-Ratio": f"{ratio:.2f}",
+            "X-Filename": quote(file.filename),
+        }
+    )
+
+
+@router.post("/compress/batch/stream")
+async def compress_batch_images_stream(files: List[UploadFile] = File(...)):
+    """批量压缩图片，以 NDJSON 流的形式逐个返回结果（按完成顺序）"""
+    if len(files) > settings.MAX_FILES_PER_BATCH:
+        raise HTTPException(400, f"最多支持 {settings.MAX_FILES_PER_BATCH} 个文件")
+
+    failures = []
+    pending = []
+
+    for file in files:
+        error = _precheck_upload(file)
+        if error:
+            failures.append(_ndjson_error(file.filename, file.size or 0, error))
+            continue
+        pending.append(file)
+
+    read_semaphore = asyncio.Semaphore(settings.MAX_CONCURRENT_READS)
+    contents = await asyncio.gather(*(_read_upload(file, read_semaphore) for file in pending))
+
+    tasks = []
+    for file, content in zip(pending, contents):
+        actual_format, error = _postcheck_content(content)
+        if error:
+            failures.append(_ndjson_error(file.filename, len(content), error))
+            continue
+
+        tasks.append(asyncio.ensure_future(
+            _compress_tagged(file.filename, content, actual_format)
+        ))
+
+    async def _gen():
+        for line in failures:
+            yield line
+
+        for next_done in asyncio.as_completed(tasks):
+            filename, original_size, target_format, outcome = await next_done
+            if isinstance(outcome, Exception):
+                yield _ndjson_error(filename, 0, str(outcome))
+                continue
+
+            compressed, compressed_size, ratio = outcome
+            yield _ndjson_line({
+                "filename": filename,
+                "original_size": original_size,
+                "compressed_size": compressed_size,
+                "compression_ratio": ratio,
+                "data": _data_url(target_format, compressed),
+                "success": True,
+                "error": None,
+                "format": target_format,
+            })
+
+    return StreamingResponse(_gen(), media_type="application/x-ndjson")
+
+
+@router.post("/compress/batch/multipart")
+async def compress_batch_images_multipart(files: List[UploadFile] = File(...)):
+    """
+    批量压缩图片，以 multipart/mixed 按上传顺序返回二进制图片
+
+    不做 base64 编码，体积比 JSON 小约 1/4；每个部分的元数据放在部分头中，
+    失败的文件以 application/json 部分返回错误信息
+    """
+    if len(files) > settings.MAX_FILES_PER_BATCH:
+        raise HTTPException(400, f"最多支持 {settings.MAX_FILES_PER_BATCH} 个文件")
+
+    errors: List[Optional[bytes]] = [None] * len(files)
+    pending = []
+
+    for index, file in enumerate(files):
+        error = _precheck_upload(file)
+        if error:
+            errors[index] = _ndjson_error(file.filename, file.size or 0, error)
+            continue
+        pending.append((index, file))
+
+    read_semaphore = asyncio.Semaphore(settings.MAX_CONCURRENT_READS)
+    contents = await asyncio.gather(*(_read_upload(file, read_semaphore) for _, file in pending))
+
+    jobs = []
+    for (index, file), content in zip(pending, contents):
+        actual_format, error = _postcheck_content(content)
+        if error:
+            errors[index] = _ndjson_error(file.filename, len(content), error)
+            continue
+        jobs.append((index, _compress_tagged(file.filename, content, actual_format)))
+
+    outcomes = dict(zip(
+        (index for index, _ in jobs),
+        await asyncio.gather(*(job for _, job in jobs))
+    ))
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    for index in range(len(files)):
+        if index not in outcomes:
+            parts.append(_multipart_part(boundary, {"Content-Type": "application/json"}, errors[index]))
+            continue
+
+        filename, original_size, target_format, outcome = outcomes[index]
+        if isinstance(outcome, Exception):
+            parts.append(_multipart_part(
+                boundary, {"Content-Type": "application/json"}, _ndjson_error(filename, 0, str(outcome))
+            ))
+            continue
+
+        compressed, compressed_size, ratio = outcome
+        parts.append(_multipart_part(boundary, {
+            "Content-Type": _MIME_MAP.get(target_format, 'image/png'),
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+            "X-Original-Size": str(original_size),
+            "X-Compressed-Size": str(compressed_size),
+            "X-Ratio": f"{ratio:.2f}",
+        }, compressed))
+
+    parts.append(f"--{boundary}--\r\n".encode())
+    return Response(content=b"".join(parts), media_type=f"multipart/mixed; boundary={boundary}")
+
+
+def _multipart_part(boundary: str, headers: dict, body: bytes) -> bytes:
+    """拼接 multipart 的一个部分 (含分隔行)"""
+    head = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    return f"--{boundary}\r\n{head}\r\n".encode() + body + b"\r\n"
+
+
+async def _compress_tagged(filename: str, content: bytes, ext: str):
+    """压缩并带上文件信息，异常作为结果返回，方便流式输出"""
+    try:
+        outcome = await batcher.submit(content, ext)
+    except Exception as e:
+        outcome = e
+    return filename, len(content), ext, outcome
+
+
+def _ndjson_error(filename: str, original_size: int, error: str) -> bytes:
+    return _ndjson_line({
+        "filename": filename,
+        "original_size": original_size,
+        "compressed_size": 0,
+        "compression_ratio": 0,
+        "data": "",
+        "success": False,
+        "error": error,
+        "format": "",
+    })
@@ -0,0 +1,175 @@
+"""
+微批处理
+把并发到达的压缩请求合并成小批次提交给进程池，摊薄每个任务的进程间通信开销
+"""
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, Optional, Tuple, Union
+
+from app.core.compressor import AdvancedCompressor, normalize_format, process_pool_context
+from app.core.config import settings
+from app.core.result_cache import content_digest, result_cache
+
+
+POOL_WORKERS = os.cpu_count() or 1
+
+
+def create_pool() -> ProcessPoolExecutor:
+    """创建压缩进程池，不在多线程的 uvicorn 进程中 fork"""
+    return ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=process_pool_context())
+
+
+compressor = AdvancedCompressor()
+
+
+def compress_one(content: bytes, ext: str) -> Tuple[bytes, int, float]:
+    """压缩单张图片，返回 (压缩数据, 压缩后大小, 压缩率)"""
+    with io.BytesIO() as output_buffer:
+        compressed_size, ratio = compressor.compress_in_memory(
+            io.BytesIO(content),
+            output_buffer,
+            ext
+        )
+        return output_buffer.getvalue(), compressed_size, ratio
+
+
+def _compress_many(items: List[Tuple[bytes, str]]) -> List[Union[Tuple[bytes, int, float], Exception]]:
+    """在工作进程中依次压缩一组图片，单张失败不影响其他图片"""
+    results = []
+    for content, ext in items:
+        try:
+            results.append(compress_one(content, ext))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class MicroBatcher:
+    """
+    微批处理器
+
+    后台任务从队列中取出请求，最多等待 max_latency_ms 凑满 max_batch_size 个，
+    再按工作进程数切分后提交到进程池；进程池在首次使用时由 pool_factory 创建，
+    工作进程异常退出导致进程池损坏时换一个新的
+    """
+
+    def __init__(
+        self,
+        pool_factory: Callable[[], ProcessPoolExecutor],
+        workers: int,
+        max_batch_size: int = settings.MAX_BATCH_SIZE,
+        max_latency_ms: int = settings.MAX_LATENCY_MS
+    ):
+        self.pool_factory = pool_factory
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.workers = workers
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._inflight: Optional[asyncio.Semaphore] = None
+        self._tasks: set = set()
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+
+        if self.pool is None:
+            self.pool = self.pool_factory()
+
+        # 队列和信号量绑定事件循环，循环变化时（如测试中多次启动应用）重新创建
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._inflight = asyncio.Semaphore(self.workers)
+        self._spawn(self._run())
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def submit(self, content: bytes, ext: str) -> Tuple[bytes, int, float]:
+        """
+        提交一张图片，返回 (压缩数据, 压缩后大小, 压缩率)
+
+        结果缓存在主进程中查找，命中时不把图片发往工作进程；哈希在线程中计算，不阻塞事件循环
+        """
+        self._ensure_started()
+        cache_key = (await asyncio.to_thread(content_digest, content), normalize_format(ext))
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            data, ratio = cached
+            return data, len(data), ratio
+
+        future = self._loop.create_future()
+        await self._queue.put((future, content, ext))
+        data, compressed_size, ratio = await future
+        result_cache.put(cache_key, data, ratio)
+        return data, compressed_size, ratio
+
+    async def _run(self):
+        while True:
+            items = [await self._queue.get()]
+            deadline = self._loop.time() + self.max_latency
+
+            while len(items) < self.max_batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # 按工作进程数切分，保证一个批次仍能用满所有核心
+            groups = min(len(items), self.workers)
+            for i in range(groups):
+                await self._inflight.acquire()
+                self._spawn(self._dispatch(items[i::groups]))
+
+    def shutdown(self):
+        """关闭进程池，应用退出时调用"""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    def _replace_pool(self, broken: ProcessPoolExecutor):
+        """丢弃损坏的进程池并新建一个；多个批次同时发现损坏时只替换一次"""
+        if self.pool is broken:
+            self.pool = self.pool_factory()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    async def _dispatch(self, items: list):
+        pool = self.pool
+        try:
+            results = await self._loop.run_in_executor(
+                pool, _compress_many, [(content, ext) for _, content, ext in items]
+            )
+        except BrokenProcessPool as e:
+            # 工作进程被杀 (如 OOM) 后进程池不可再用；只让在途的批次失败，后续请求交给新进程池
+            self._replace_pool(pool)
+            results = [e] * len(items)
+        except Exception as e:
+            results = [e] * len(items)
+        finally:
+            self._inflight.release()
+
+        for (future, _, _), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+batcher = MicroBatcher(create_pool, POOL_WORKERS)
+
+
+async def submit(content: bytes, ext: str) -> Tuple[bytes, int, float]:
+    """通过微批处理器压缩图片"""
+    return await batcher.submit(content, ext)
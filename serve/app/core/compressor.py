@@ -2,16 +2,23 @@
 高级图片压缩引擎
 使用 imagequant + zlib 实现高质量 PNG 压缩 (与 wasm-image-compressor 相同算法)
 """
+import functools
 import io
+import logging
+import multiprocessing
 import os
 import subprocess
-import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import zlib
 import struct
-from typing import Tuple, Optional
-from PIL import Image, ImageFile
+from typing import BinaryIO, Tuple, Optional, Union
+from PIL import Image, ImageChops, ImageFile, ImageStat, features
 from pathlib import Path
 
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
 
 try:
     import pillow_avif
@@ -26,6 +33,26 @@ except ImportError:
     print("[警告] mozjpeg-lossless-optimization 未安装，JPEG 将使用 Pillow 默认压缩")
 
 
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+
+# 系统自带的 libturbojpeg 与 Pillow 用的是同一个 libjpeg-turbo，没有收益；
+# 只有 TURBOJPEG_LIB_PATH 指向基于 mozjpeg 构建的 libturbojpeg 时才启用
+HAS_TURBOJPEG = False
+if os.environ.get('TURBOJPEG_LIB_PATH'):
+    try:
+        from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420, TJFLAG_PROGRESSIVE
+        turbojpeg = TurboJPEG(os.environ['TURBOJPEG_LIB_PATH'])
+        HAS_TURBOJPEG = True
+        print("[turbojpeg] 已启用 (mozjpeg)")
+    except Exception as e:
+        print(f"[turbojpeg] 加载失败: {e}")
+
+
 try:
     import imagequant
     HAS_IMAGEQUANT = True
@@ -34,6 +61,13 @@ except ImportError:
     HAS_IMAGEQUANT = False
     print("[警告] imagequant 未安装，将使用备用方案")
 
+try:
+    # 直接使用 libimagequant 的 C 接口，以便复用 liq_attr
+    from imagequant._libimagequant import lib as liq_lib, ffi as liq_ffi
+    HAS_LIQ_CAPI = True
+except ImportError:
+    HAS_LIQ_CAPI = False
+
 
 try:
     from zopfli.zopfli import compress as zopfli_compress
@@ -44,6 +78,23 @@ except ImportError:
     print("[警告] zopfli 未安装，将使用 zlib")
 
 
+try:
+    # Intel ISA-L，快速模式下的 deflate 和 CRC 都比标准 zlib 快得多
+    from isal import isal_zlib
+    HAS_ISAL = True
+except ImportError:
+    HAS_ISAL = False
+
+
+try:
+    # oxipng 的 Python 绑定，进程内优化，省去启动 oxipng 子进程
+    import oxipng
+    HAS_PYOXIPNG = True
+    print("[pyoxipng] 已启用")
+except ImportError:
+    HAS_PYOXIPNG = False
+
+
 try:
     import png
     HAS_PYPNG = True
@@ -55,7 +106,6 @@ except ImportError:
 
 import shutil
 PNGQUANT_PATH = None
-HAS_PNGQUANT = False
 
 
 local_pngquant = Path(__file__).parent.parent.parent / "bin" / "pngquant.exe"
@@ -67,21 +117,14 @@ else:
     if system_pngquant:
         PNGQUANT_PATH = Path(system_pngquant)
 
-if PNGQUANT_PATH:
-    try:
-        result = subprocess.run([str(PNGQUANT_PATH), "--version"], capture_output=True, timeout=5)
-        HAS_PNGQUANT = result.returncode == 0
-        if HAS_PNGQUANT:
-            print(f"[pngquant] 已启用: {PNGQUANT_PATH}")
-    except Exception:
-        pass
-
-if not HAS_PNGQUANT:
+if PNGQUANT_PATH is None:
     print("[警告] pngquant 未找到，PNG 将使用 Pillow 压缩")
 
+# pngquant 退出码：98 结果比原图大，99 质量不达标；这两种情况不写输出，保留原图
+PNGQUANT_SKIP_CODES = (98, 99)
+
 
 OXIPNG_PATH = None
-HAS_OXIPNG = False
 
 local_oxipng = Path(__file__).parent.parent.parent / "bin" / "oxipng.exe"
 if local_oxipng.exists():
@@ -91,17 +134,220 @@ else:
     if system_oxipng:
         OXIPNG_PATH = Path(system_oxipng)
 
-if OXIPNG_PATH:
+
+
+@functools.lru_cache(maxsize=None)
+def _probe_tool(name: str, path: Optional[Path]) -> bool:
+    """
+    首次使用时检查外部工具能否运行，结果缓存
+
+    不在导入时探测，避免每个新进程导入模块都要启动子进程
+    """
+    if path is None:
+        return False
+    try:
+        available = subprocess.run([str(path), "--version"], capture_output=True, timeout=5).returncode == 0
+    except Exception:
+        available = False
+
+    if available:
+        print(f"[{name}] 已启用: {path}")
+    else:
+        print(f"[警告] {name} 无法运行: {path}")
+    return available
+
+
+def has_pngquant() -> bool:
+    return _probe_tool("pngquant", PNGQUANT_PATH)
+
+
+def has_oxipng() -> bool:
+    return HAS_PYOXIPNG or _probe_tool("oxipng", OXIPNG_PATH)
+
+
+# mozjpeg 的 cjpeg (默认开启 trellis 量化)，可通过 MOZJPEG_CJPEG_PATH 指定
+CJPEG_PATH = None
+
+for candidate in (os.environ.get('MOZJPEG_CJPEG_PATH'), '/opt/mozjpeg/bin/cjpeg', shutil.which('cjpeg')):
+    if candidate and Path(candidate).exists():
+        CJPEG_PATH = Path(candidate)
+        break
+
+
+@functools.lru_cache(maxsize=None)
+def has_mozjpeg_cjpeg() -> bool:
+    """首次使用时检查 cjpeg 是否为 mozjpeg 构建，libjpeg-turbo 自带的 cjpeg 没有 trellis 量化"""
+    if CJPEG_PATH is None:
+        return False
     try:
-        result = subprocess.run([str(OXIPNG_PATH), "--version"], capture_output=True, timeout=5)
-        HAS_OXIPNG = result.returncode == 0
-        if HAS_OXIPNG:
-            print(f"[oxipng] 已启用: {OXIPNG_PATH}")
+        result = subprocess.run([str(CJPEG_PATH), '-version'], capture_output=True, timeout=5)
+        available = b'mozjpeg' in (result.stdout + result.stderr).lower()
     except Exception:
-        pass
+        available = False
+
+    if available:
+        print(f"[mozjpeg] 已启用: {CJPEG_PATH}")
+    return available
 
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
+# 加大编码缓冲区，避免 optimize/progressive 的大图 JPEG 编码反复刷新缓冲
+ImageFile.MAXBLOCK = 2 ** 22
+
+
+# jpeglib_version 只报告 ABI 版本 (如 6.2/8.0)，是否为 libjpeg-turbo 需要单独检测
+try:
+    HAS_LIBJPEG_TURBO = bool(features.check_feature('libjpeg_turbo'))
+except Exception:
+    HAS_LIBJPEG_TURBO = False
+
+if HAS_LIBJPEG_TURBO:
+    print(f"[libjpeg-turbo] 已启用: {features.version_feature('libjpeg_turbo')}")
+else:
+    print("[警告] Pillow 未使用 libjpeg-turbo，JPEG 编解码无 SIMD 加速")
+
+# Pillow 链接了 libimagequant 时，备用方案的量化也用它，效果优于八叉树
+try:
+    PILLOW_HAS_LIBIMAGEQUANT = bool(features.check_feature('libimagequant'))
+except Exception:
+    PILLOW_HAS_LIBIMAGEQUANT = False
+
+
+# JPEG 标准亮度量化表 (ITU-T T.81 Annex K) 之和，用于估算原图质量
+STD_LUMINANCE_QUANT_SUM = sum([
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+])
+
+
+LIQ_SPEED = 4
+_liq_local = threading.local()
+
+
+def _get_liq_attr(max_colors: int, min_quality: int, max_quality: int):
+    """每个线程按参数复用 liq_attr，避免每张图片重新创建"""
+    attrs = getattr(_liq_local, 'attrs', None)
+    if attrs is None:
+        attrs = _liq_local.attrs = {}
+
+    key = (max_colors, min_quality, max_quality)
+    attr = attrs.get(key)
+    if attr is None:
+        attr = liq_ffi.gc(liq_lib.liq_attr_create(), liq_lib.liq_attr_destroy)
+        liq_lib.liq_set_max_colors(attr, max_colors)
+        liq_lib.liq_set_speed(attr, LIQ_SPEED)
+        liq_lib.liq_set_quality(attr, min_quality, max_quality)
+        attrs[key] = attr
+    return attr
+
+
+def quantize_rgba(
+    rgba_data: bytes,
+    width: int,
+    height: int,
+    max_colors: int = 256,
+    min_quality: int = 0,
+    max_quality: int = 100,
+    dithering_level: float = 1.0
+) -> Tuple[bytes, list]:
+    """
+    使用 libimagequant 量化 RGBA 像素
+
+    Returns:
+        (索引像素 (bytes-like), 平铺的调色板 [r0, g0, b0, a0, ...] (bytes 或 list))
+    """
+    if not HAS_LIQ_CAPI:
+        return imagequant.quantize_raw_rgba_bytes(
+            rgba_data,
+            width,
+            height,
+            dithering_level=dithering_level,
+            max_colors=max_colors,
+            min_quality=min_quality,
+            max_quality=max_quality
+        )
+
+    attr = _get_liq_attr(max_colors, min_quality, max_quality)
+    liq_image = liq_lib.liq_image_create_rgba(attr, rgba_data, width, height, 0)
+    if liq_image == liq_ffi.NULL:
+        raise RuntimeError("liq_image_create_rgba failed")
+
+    result_p = liq_ffi.new("liq_result**")
+    try:
+        code = liq_lib.liq_image_quantize(liq_image, attr, result_p)
+        if code != liq_lib.LIQ_OK:
+            raise RuntimeError(imagequant._get_error_msg(code))
+
+        try:
+            liq_lib.liq_set_dithering_level(result_p[0], dithering_level)
+            pixels = liq_ffi.new("char[]", width * height)
+            liq_lib.liq_write_remapped_image(result_p[0], liq_image, pixels, width * height)
+
+            pal = liq_lib.liq_get_palette(result_p[0])
+            # liq_color 是连续的 4 字节 RGBA 结构体，整块读取即为平铺的调色板
+            palette = liq_ffi.buffer(pal.entries, pal.count * 4)[:]
+            # 直接返回 cffi 缓冲区（持有 pixels 的引用），省去一次 W*H 的拷贝
+            return liq_ffi.buffer(pixels), palette
+        finally:
+            liq_lib.liq_result_destroy(result_p[0])
+    finally:
+        liq_lib.liq_image_destroy(liq_image)
+
+
+AVIF_BRANDS = (b'avif', b'avis')
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """
+    根据文件头识别真实图片格式，不依赖扩展名
+
+    Args:
+        data: 文件内容，至少包含完整的 ftyp box (AVIF 需要检查其中的兼容品牌)
+
+    Returns:
+        'png' / 'jpeg' / 'webp' / 'avif'，无法识别时返回 None
+    """
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[4:8] == b'ftyp':
+        # ftyp: box 大小, 'ftyp', 主品牌, 次版本号, 兼容品牌列表；
+        # 主品牌可能是 mif1/miaf 等通用品牌，avif 只出现在兼容品牌中
+        box_size = int.from_bytes(data[:4], 'big')
+        brands = [data[8:12]] + [data[i:i + 4] for i in range(16, min(box_size, len(data)) - 3, 4)]
+        if any(brand in AVIF_BRANDS for brand in brands):
+            return 'avif'
+    return None
+
+
+# 输出格式别名，统一为 Pillow 的格式名
+FORMAT_ALIASES = {'JPG': 'JPEG'}
+
+
+def normalize_format(fmt: str) -> str:
+    """输出格式转为大写的 Pillow 格式名，如 'jpg' -> 'JPEG'"""
+    fmt = fmt.upper()
+    return FORMAT_ALIASES.get(fmt, fmt)
+
+
+def process_pool_context():
+    """
+    进程池使用的 multiprocessing 上下文
+
+    不 fork 已启动线程的进程：pyoxipng 等库的线程池在 fork 出的子进程中会死锁，
+    优先用 forkserver，不支持时 (Windows) 用 spawn
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
 
 
 class AdvancedCompressor:
@@ -120,7 +366,10 @@ class AdvancedCompressor:
         output_path: str,
         quality: int = 85,
         output_format: Optional[str] = None,
-        use_pngquant: bool = True
+        use_pngquant: bool = True,
+        dynamic_quality: bool = False,
+        original_size: Optional[int] = None,
+        image: Optional[Image.Image] = None
     ) -> Tuple[int, int, float]:
         """
         压缩图片
@@ -131,89 +380,220 @@ class AdvancedCompressor:
             quality: 压缩质量 (1-100)
             output_format: 输出格式 (None=保持原格式)
             use_pngquant: PNG 是否使用 pngquant 有损压缩
+            dynamic_quality: JPEG 是否按图片内容在 quality 以下查找更低的质量
+            original_size: 已知的输入文件大小 (None=读取文件信息)
+            image: 已打开的 input_path 图片 (如先调用过 get_optimal_format)，传入时不再重新打开解码
 
         Returns:
             (原始大小, 压缩后大小, 压缩率)
         """
-        original_size = os.path.getsize(input_path)
+        if image is not None:
+            if original_size is None:
+                original_size = os.path.getsize(input_path)
+            self._compress_from_image(image, output_path, quality, output_format, use_pngquant, dynamic_quality)
+        else:
+            # 只打开一次文件，大小从已打开的句柄上 fstat 取得
+            with open(input_path, 'rb') as fp:
+                if original_size is None:
+                    original_size = os.fstat(fp.fileno()).st_size
+                with Image.open(fp) as img:
+                    self._compress_from_image(img, output_path, quality, output_format, use_pngquant, dynamic_quality)
 
-        with Image.open(input_path) as img:
+        compressed_size = os.path.getsize(output_path)
+        compression_ratio = (1 - compressed_size / original_size) * 100
 
-            original_format = img.format
-            target_format = output_format or original_format
+        return original_size, compressed_size, compression_ratio
 
+    def _compress_from_image(
+        self,
+        img: Image.Image,
+        output_path: str,
+        quality: int,
+        output_format: Optional[str],
+        use_pngquant: bool,
+        dynamic_quality: bool
+    ):
+        """把已打开的图片压缩写入 output_path"""
+        target_format = normalize_format(output_format or img.format)
+        img = self._normalize_mode(img, target_format)
+
+
+        if target_format == 'PNG':
+            self._compress_png(img, output_path, quality, use_pngquant)
+        elif target_format == 'JPEG':
+            self._compress_jpeg(img, output_path, quality, dynamic_quality)
+        elif target_format == 'WEBP':
+            self._compress_webp(img, output_path, quality)
+        elif target_format == 'AVIF':
+            self._compress_avif(img, output_path, quality)
+        else:
+            raise ValueError(f"Unsupported format: {target_format}")
 
-            if target_format in ['JPEG', 'JPG'] and img.mode in ['RGBA', 'LA', 'P']:
+    def compress_to_budget(
+        self,
+        input_path: str,
+        output_path: str,
+        max_bytes: int,
+        output_format: Optional[str] = None,
+        min_quality: int = 30,
+        max_quality: int = 95,
+        tolerance: float = 0.025
+    ) -> Tuple[int, int, float, int]:
+        """
+        压缩到指定字节数以内
 
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode in ['RGBA', 'LA'] else None)
-                img = background
-            elif img.mode not in ['RGB', 'RGBA']:
-                img = img.convert('RGBA' if target_format in ['PNG', 'WEBP', 'AVIF'] else 'RGB')
+        只解码一次，在 [min_quality, max_quality] 内二分查找不超过 max_bytes 的最高质量，
+        结果只保存在内存中，最后把选中的一份写入 output_path；
+        结果距上限不足 tolerance 时提前结束。最低质量仍超出上限时写入最低质量的结果
 
+        Args:
+            output_format: 输出格式 (None=保持原格式)，只支持有损格式 JPEG/WEBP/AVIF
 
-            if target_format == 'PNG':
-                self._compress_png(img, output_path, quality, use_pngquant)
-            elif target_format in ['JPEG', 'JPG']:
-                self._compress_jpeg(img, output_path, quality)
-            elif target_format == 'WEBP':
-                self._compress_webp(img, output_path, quality)
-            elif target_format == 'AVIF':
-                self._compress_avif(img, output_path, quality)
+        Returns:
+            (原始大小, 压缩后大小, 压缩率, 选中的质量)
+        """
+        with open(input_path, 'rb') as fp:
+            original_size = os.fstat(fp.fileno()).st_size
+            with Image.open(fp) as img:
+                target_format = normalize_format(output_format or img.format)
+                if target_format not in ('JPEG', 'WEBP', 'AVIF'):
+                    raise ValueError(f"Unsupported format for byte budget: {target_format}")
+
+                img = self._normalize_mode(img, target_format)
+                img.load()
+
+        low, high = min_quality, max_quality
+        best = None
+        smallest = None
+        while low <= high:
+            quality = (low + high) // 2
+            data = self._encode_at_quality(img, target_format, quality)
+            if smallest is None or len(data) < len(smallest[1]):
+                smallest = (quality, data)
+
+            if len(data) <= max_bytes:
+                best = (quality, data)
+                if len(data) >= max_bytes * (1 - tolerance):
+                    break
+                low = quality + 1
             else:
-                raise ValueError(f"Unsupported format: {target_format}")
+                high = quality - 1
 
-        compressed_size = os.path.getsize(output_path)
+        quality, data = best or smallest
+        with open(output_path, 'wb') as f:
+            f.write(data)
+
+        compressed_size = len(data)
         compression_ratio = (1 - compressed_size / original_size) * 100
+        return original_size, compressed_size, compression_ratio, quality
+
+    def _encode_at_quality(self, img: Image.Image, target_format: str, quality: int) -> bytes:
+        """按指定质量编码有损格式，结果与 compress_image 写出的文件一致"""
+        if target_format == 'JPEG':
+            jpeg_bytes = self._encode_jpeg_cjpeg(img, quality)
+            if jpeg_bytes is not None:
+                return jpeg_bytes
+            jpeg_bytes = self._encode_jpeg(img, quality)
+            if HAS_MOZJPEG:
+                try:
+                    jpeg_bytes = mozjpeg_lossless_optimization.optimize(jpeg_bytes)
+                except Exception as e:
+                    logger.warning("[JPEG压缩] MozJPEG 优化失败: %s", e)
+            return jpeg_bytes
+
+        with io.BytesIO() as buffer:
+            if target_format == 'WEBP':
+                img.save(buffer, 'WEBP', quality=quality, method=settings.WEBP_METHOD, lossless=False)
+            else:
+                img.save(buffer, 'AVIF', quality=quality, speed=settings.AVIF_SPEED)
+            return buffer.getvalue()
+
+    def _normalize_mode(self, img: Image.Image, target_format: str) -> Image.Image:
+        """按目标格式转换颜色模式：JPEG 合成掉透明通道，其余格式统一为 RGB/RGBA"""
+        if target_format == 'JPEG' and img.mode in ['RGBA', 'LA', 'P']:
+            return self._flatten_alpha(img)
+        if img.mode not in ['RGB', 'RGBA']:
+            return img.convert('RGBA' if target_format in ['PNG', 'WEBP', 'AVIF'] else 'RGB')
+        return img
+
+    def _flatten_alpha(self, img: Image.Image) -> Image.Image:
+        """把带透明通道的图片合成到白色背景上，转为 RGB"""
+        if img.mode == 'P':
+            img = img.convert('RGBA')
 
-        return original_size, compressed_size, compression_ratio
+        # 透明通道全为 255 时没有需要合成的像素，直接丢弃透明通道
+        if img.getextrema()[-1][0] == 255:
+            return img.convert('RGB')
+
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        # RGBA/LA 图片本身可直接作为蒙版（取其透明通道），省去 split() 拆出全部通道的拷贝
+        background.paste(img, mask=img)
+        return background
 
     def _compress_png(self, img: Image.Image, output_path: str, quality: int, use_pngquant: bool):
-        """PNG 压缩 - 使用 pngquant CLI (与 TinyPNG 相同效果)"""
+        """PNG 压缩 - 优先使用进程内的 imagequant，其次 pngquant CLI (与 TinyPNG 相同效果)"""
+
+        if use_pngquant and HAS_IMAGEQUANT:
+            # 直接调用 libimagequant，省去每张图片启动一次 pngquant 进程
+            try:
+                with open(output_path, 'wb') as f:
+                    compressor_name = self._write_quantized_png(img, f)
+                logger.debug("[PNG压缩] imagequant + %s 完成", compressor_name)
+                return
+            except Exception as e:
+                logger.warning("[PNG压缩] imagequant 失败: %s", e)
 
-        if not use_pngquant or not HAS_PNGQUANT:
+        if not use_pngquant or not has_pngquant():
             img.save(output_path, 'PNG', optimize=True, compress_level=9)
             return
 
 
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-            tmp_path = tmp.name
-            img.save(tmp_path, 'PNG')
-
         try:
-
-
-
-
-            result = subprocess.run([
-                str(PNGQUANT_PATH),
-                '254',
-                '--speed=1',
-                '--strip',
-                '--force',
-                '--output', output_path,
-                tmp_path
-            ], capture_output=True, timeout=60)
-
-            if result.returncode == 0:
-                print(f"[PNG压缩] pngquant 压缩完成")
+            quantized = self._run_pngquant(self._encode_png(img), speed=1)
+            if quantized is not None:
+                quantized = self._oxipng_post_pass(quantized)
+                with open(output_path, 'wb') as f:
+                    f.write(quantized)
+                logger.debug("[PNG压缩] pngquant 压缩完成")
             else:
-                print(f"[PNG压缩] pngquant 失败 (code={result.returncode})，使用 Pillow")
+                logger.warning("[PNG压缩] pngquant 失败，使用 Pillow")
                 img.save(output_path, 'PNG', optimize=True, compress_level=9)
         except Exception as e:
-            print(f"[PNG压缩] pngquant 异常: {e}，使用 Pillow")
+            logger.warning("[PNG压缩] pngquant 异常: %s，使用 Pillow", e)
             img.save(output_path, 'PNG', optimize=True, compress_level=9)
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
+
+    def _encode_png(self, img: Image.Image) -> bytes:
+        """把图片编码为未优化的 PNG 字节，作为 pngquant 的输入"""
+        buf = io.BytesIO()
+        img.save(buf, 'PNG', compress_level=1)
+        return buf.getvalue()
+
+    def _run_pngquant(self, png_bytes: bytes, speed: int) -> Optional[bytes]:
+        """通过 stdin/stdout 调用 pngquant，不落盘；失败时返回 None"""
+        result = subprocess.run([
+            str(PNGQUANT_PATH),
+            '254',
+            f'--speed={speed}',
+            '--strip',
+            '-'
+        ], input=png_bytes, capture_output=True, timeout=60)
+
+        if result.returncode != 0 or not result.stdout:
+            logger.debug("[PNG压缩] pngquant 返回 code=%s", result.returncode)
+            return None
+        return result.stdout
 
     def _oxipng_optimize(self, filepath: str):
         """使用 oxipng 无损优化 PNG"""
-        if not HAS_OXIPNG:
+        if HAS_PYOXIPNG:
+            try:
+                oxipng.optimize(filepath, level=6, strip=oxipng.StripChunks.all())
+                logger.debug("[PNG压缩] oxipng 优化完成")
+            except Exception as e:
+                logger.warning("[PNG压缩] oxipng 优化失败: %s", e)
+            return
+
+        if not has_oxipng():
             return
 
         try:
@@ -227,17 +607,17 @@ class AdvancedCompressor:
             ], capture_output=True, timeout=60)
 
             if result.returncode == 0:
-                print(f"[PNG压缩] oxipng 优化完成")
+                logger.debug("[PNG压缩] oxipng 优化完成")
         except Exception as e:
-            print(f"[PNG压缩] oxipng 优化失败: {e}")
+            logger.warning("[PNG压缩] oxipng 优化失败: %s", e)
 
-    def _compress_png_imagequant(self, img: Image.Image, output_buffer: io.BytesIO, max_colors: int = 256, fast_mode: bool = True):
+    def _compress_png_imagequant(self, img: Image.Image, output_buffer: BinaryIO, max_colors: int = 256, fast_mode: bool = True):
         """
         使用 imagequant 实现高压缩率 PNG
 
         Args:
             img: PIL Image
-            output_buffer: 输出缓冲区
+            output_buffer: 输出缓冲区或已打开的文件
             max_colors: 最大颜色数
             fast_mode: True=快速模式(zlib,~1秒), False=最佳压缩(zopfli,~5秒)
         """
@@ -249,122 +629,62 @@ class AdvancedCompressor:
             img = img.convert('RGBA')
 
         width, height = img.size
-        rgba_data = img.tobytes()
-
 
-        indexed_pixels, palette = imagequant.quantize_raw_rgba_bytes(
-            rgba_data,
+        # RGBA 数据不保留局部引用，量化结束即可释放，不与后续的 PNG 压缩同时占用内存
+        indexed_pixels, palette = quantize_rgba(
+            img.tobytes(),
             width,
             height,
-            dithering_level=1.0,
             max_colors=max_colors,
             min_quality=70,
-            max_quality=100
+            max_quality=100,
+            dithering_level=1.0
         )
 
 
-        png_data = self._build_png(width, height, palette, indexed_pixels, fast_mode=fast_mode)
-        output_buffer.write(png_data)
-
-    def _optimize_pixel_repetition(self, indexed_pixels: bytes, palette: list, width: int, height: int, threshold: int = 5) -> bytes:
-        """
-        后处理优化：使用 NumPy 向量化加速
-        如果当前像素与左边像素的颜色差异小于阈值，则改为左边像素的颜色
-        """
-        try:
-            import numpy as np
-            return self._optimize_pixel_repetition_numpy(indexed_pixels, palette, width, height, threshold)
-        except ImportError:
-            return self._optimize_pixel_repetition_pure(indexed_pixels, palette, width, height, threshold)
-
-    def _optimize_pixel_repetition_numpy(self, indexed_pixels: bytes, palette: list, width: int, height: int, threshold: int) -> bytes:
-        """NumPy 向量化版本 - 快速"""
-        import numpy as np
-
-
-        num_colors = len(palette) // 4
-        pal_rgb = np.array(palette, dtype=np.int32).reshape(-1, 4)[:, :3] 
-
-        pixels = np.frombuffer(indexed_pixels, dtype=np.uint8).copy()
-        pixels_2d = pixels.reshape(height, width)
-
-
-        for y in range(height):
-            row = pixels_2d[y]
-            for x in range(1, width):
-                if row[x] != row[x-1]:
-
-                    c1 = pal_rgb[row[x]]
-                    c2 = pal_rgb[row[x-1]]
-                    diff = np.sum((c1 - c2) ** 2)
-                    if diff < threshold:
-                        row[x] = row[x-1]
-
-        return pixels.tobytes()
-
-    def _optimize_pixel_repetition_pure(self, indexed_pixels: bytes, palette: list, width: int, height: int, threshold: int) -> bytes:
-        """纯 Python 版本 - 备用"""
-        pixels = bytearray(indexed_pixels)
-        num_colors = len(palette) // 4
-
-        def color_diff(idx1, idx2):
-            if idx1 >= num_colors or idx2 >= num_colors:
-                return 999999
-            r1, g1, b1 = palette[idx1*4], palette[idx1*4+1], palette[idx1*4+2]
-            r2, g2, b2 = palette[idx2*4], palette[idx2*4+1], palette[idx2*4+2]
-            return (r1-r2)**2 + (g1-g2)**2 + (b1-b2)**2
+        self._write_png(output_buffer, width, height, palette, indexed_pixels, fast_mode)
 
-        for y in range(height):
-            for x in range(1, width):
-                pos = y * width + x
-                prev_pos = pos - 1
-                if pixels[pos] != pixels[prev_pos]:
-                    diff = color_diff(pixels[pos], pixels[prev_pos])
-                    if diff < threshold:
-                        pixels[pos] = pixels[prev_pos]
-
-        return bytes(pixels)
+    def _oxipng_post_pass(self, png_data: bytes) -> bytes:
+        """pngquant 只用 zlib 压缩，较大的结果再交给 oxipng 重新压缩；小文件收益不抵开销，直接返回"""
+        if len(png_data) <= settings.OXIPNG_MIN_BYTES or not has_oxipng():
+            return png_data
+        optimized = self._oxipng_optimize_bytes(png_data)
+        return optimized if len(optimized) < len(png_data) else png_data
 
     def _oxipng_optimize_bytes(self, png_data: bytes) -> bytes:
-        """使用 oxipng 优化 PNG 字节"""
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-            tmp_path = tmp.name
-            tmp.write(png_data)
+        """使用 oxipng 优化 PNG 字节，优先进程内调用，否则通过 stdin/stdout 传输，不落盘"""
+        if HAS_PYOXIPNG:
+            try:
+                return oxipng.optimize_from_memory(png_data, level=4, strip=oxipng.StripChunks.all())
+            except Exception as e:
+                logger.warning("[PNG压缩] oxipng 优化失败: %s", e)
+                return png_data
 
         try:
-
             result = subprocess.run([
                 str(OXIPNG_PATH),
                 '-o', '4',
                 '--strip', 'all',
-                tmp_path
-            ], capture_output=True, timeout=30)
+                '--stdout',
+                '-'
+            ], input=png_data, capture_output=True, timeout=30)
 
-            if result.returncode == 0:
-                with open(tmp_path, 'rb') as f:
-                    return f.read()
+            if result.returncode == 0 and result.stdout:
+                return result.stdout
         except Exception:
             pass
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
 
         return png_data
 
-    def _build_png(self, width: int, height: int, palette: list, indexed_pixels: bytes, fast_mode: bool = False) -> bytes:
+    def _write_png(self, output: BinaryIO, width: int, height: int, palette: list, indexed_pixels: bytes, fast_mode: bool):
         """
-        手动构建 PNG 文件
+        手动构建调色板 PNG，把各个 chunk 依次写入 output
 
         Args:
             palette: 平铺的调色板 [r0, g0, b0, a0, r1, g1, b1, a1, ...]
             indexed_pixels: 索引像素数据
-            fast_mode: True=使用zlib快速压缩, False=使用zopfli最佳压缩
+            fast_mode: True=使用isal/zlib快速压缩, False=使用zopfli最佳压缩
         """
-        output = io.BytesIO()
-
-
         output.write(b'\x89PNG\r\n\x1a\n')
 
 
@@ -372,99 +692,325 @@ class AdvancedCompressor:
         self._write_chunk(output, b'IHDR', ihdr_data)
 
 
-        num_colors = len(palette) // 4
-        plte_data = bytes([palette[i * 4 + c] for i in range(num_colors) for c in range(3)])
-        self._write_chunk(output, b'PLTE', plte_data)
+        # 调色板按 RGBA 平铺，用步长切片拆出 RGB 和 Alpha，避免逐项遍历
+        rgba = bytes(palette[:len(palette) // 4 * 4])  # 兼容 list 和 bytes
+        plte_data = bytearray(len(rgba) // 4 * 3)
+        for c in range(3):
+            plte_data[c::3] = rgba[c::4]
+        self._write_chunk(output, b'PLTE', bytes(plte_data))
 
 
-        trns_data = bytes([palette[i * 4 + 3] for i in range(num_colors)])
-        while trns_data and trns_data[-1] == 255:
-            trns_data = trns_data[:-1]
+        trns_data = rgba[3::4].rstrip(b'\xff')
         if trns_data:
             self._write_chunk(output, b'tRNS', trns_data)
 
 
-        raw_data = b''.join(
-            b'\x00' + indexed_pixels[y * width:(y + 1) * width]
-            for y in range(height)
-        )
+        # 分条带并行只用于最佳压缩；快速模式 (包括交给 oxipng 重新压缩的中间结果) 大图也走流式压缩
+        large = not fast_mode and width * height > settings.PNG_PARALLEL_DEFLATE_PIXELS
 
+        if fast_mode and HAS_ISAL:
+            # ISA-L 最高级别 3：压缩率略低于 zlib -9，但快一个数量级；按行块流式压缩，不生成完整的过滤数据
+            compressed = self._deflate_rows(isal_zlib.compressobj(3, isal_zlib.DEFLATED, 15, 9), indexed_pixels, width, height)
+        elif fast_mode:
+            compressed = self._deflate_rows(zlib.compressobj(9, zlib.DEFLATED, 15, 9), indexed_pixels, width, height)
+        else:
+            raw_data = self._filter_scanlines(indexed_pixels, width, height)
+            if not large:
+                raw_data = self._choose_scanline_filters(raw_data, indexed_pixels, width, height)
 
-        if fast_mode or not HAS_ZOPFLI:
+            if large:
+                # 大图按行切分为条带并行压缩，zopfli 在这种尺寸下耗时过长
+                compressed = self._deflate_strips_parallel(raw_data, width + 1, height)
+            elif not HAS_ZOPFLI:
 
-            compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
-            compressed = compressor.compress(raw_data) + compressor.flush()
-        else:
+                compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+                compressed = compressor.compress(raw_data) + compressor.flush()
+            else:
 
-            compressed = zopfli_compress(raw_data, numiterations=15, gzip_mode=0)
+                compressed = zopfli_compress(raw_data, numiterations=15, gzip_mode=0)
 
         self._write_chunk(output, b'IDAT', compressed)
 
 
         self._write_chunk(output, b'IEND', b'')
 
-        return output.getvalue()
+    def _filter_scanlines(self, indexed_pixels: bytes, width: int, height: int) -> bytes:
+        """每行前加上过滤类型字节 0 (None)，一次性写入预分配的数组"""
+        if not HAS_NUMPY:
+            # 预分配整块缓冲区，每行首字节默认为 0，只需按行拷贝像素
+            stride = width + 1
+            rows = bytearray(stride * height)
+            for y in range(height):
+                rows[y * stride + 1:(y + 1) * stride] = indexed_pixels[y * width:(y + 1) * width]
+            return bytes(rows)
+
+        rows = np.zeros((height, width + 1), dtype=np.uint8)
+        rows[:, 1:] = np.frombuffer(indexed_pixels, dtype=np.uint8, count=width * height).reshape(height, width)
+        return rows.tobytes()
+
+    def _deflate_rows(self, compressor, indexed_pixels: bytes, width: int, height: int) -> bytes:
+        """
+        按行块加过滤字节后直接送入 compressor，流式压缩
+
+        只在内存中保留一个行块 (约 256KB) 的过滤数据，而不是整张图片的
+        """
+        view = memoryview(indexed_pixels).cast('B')
+        rows_per_block = max(1, (256 * 1024) // (width + 1))
+        parts = []
+        for y in range(0, height, rows_per_block):
+            rows = min(rows_per_block, height - y)
+            block = self._filter_scanlines(view[y * width:(y + rows) * width], width, rows)
+            parts.append(compressor.compress(block))
+        parts.append(compressor.flush())
+        return b''.join(parts)
+
+    def _choose_scanline_filters(self, raw_data: bytes, indexed_pixels: bytes, width: int, height: int) -> bytes:
+        """
+        按 libpng 的最小绝对值和启发式为每行选择过滤类型 (None/Sub/Up/Average/Paeth)
+
+        调色板图片上自适应过滤不一定更好，所以先用 zlib 快速压缩比较两种结果，
+        只有更小时才采用，之后再交给 zopfli 做最终压缩
+        """
+        if not HAS_NUMPY:
+            return raw_data
+
+        # 按约 256KB 的行块打分，临时数组只占一个行块的大小，并在行块之间复用
+        stride = width + 1
+        rows_per_block = max(1, (256 * 1024) // stride)
+        pixels = np.frombuffer(indexed_pixels, dtype=np.uint8, count=width * height).reshape(height, width)
+        rows = np.empty((height, stride), dtype=np.uint8)
+
+        # padded 第 0 行放上一行像素，第 0 列恒为 0，作为最左侧像素的 left/up_left
+        padded = np.zeros((rows_per_block + 1, stride), dtype=np.int16)
+        scratch = np.empty((rows_per_block, width), dtype=np.int16)
+        candidates = np.empty((5, rows_per_block, width), dtype=np.uint8)
+        costs = np.empty((5, rows_per_block), dtype=np.int64)
+
+        for y in range(0, height, rows_per_block):
+            n = min(rows_per_block, height - y)
+            padded[0, 1:] = pixels[y - 1] if y > 0 else 0
+            padded[1:n + 1, 1:] = pixels[y:y + n]
+
+            cur = padded[1:n + 1, 1:]
+            left = padded[1:n + 1, :-1]
+            up = padded[:n, 1:]
+            up_left = padded[:n, :-1]
+
+            p = left + up - up_left
+            pa = np.abs(p - left)
+            pb = np.abs(p - up)
+            pc = np.abs(p - up_left)
+            paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+
+            # 过滤类型 0-4 依次为 None / Sub / Up / Average / Paeth，结果按 256 取模
+            block = scratch[:n]
+            for filter_type, predictor in enumerate((0, left, up, (left + up) // 2, paeth)):
+                np.subtract(cur, predictor, out=block)
+                np.copyto(candidates[filter_type, :n], block, casting='unsafe')
+                # 把每个字节视为有符号数，取绝对值之和
+                np.copyto(block, candidates[filter_type, :n].view(np.int8))
+                costs[filter_type, :n] = np.abs(block, out=block).sum(axis=1)
+
+            choice = costs[:, :n].argmin(axis=0)
+            rows[y:y + n, 0] = choice
+            rows[y:y + n, 1:] = candidates[choice, np.arange(n)]
+
+        filtered = rows.tobytes()
+
+        if len(zlib.compress(filtered, 6)) < len(zlib.compress(raw_data, 6)):
+            return filtered
+        return raw_data
+
+    def _deflate_strips_parallel(self, raw_data: bytes, stride: int, height: int) -> bytes:
+        """
+        多线程分条带压缩，拼接成一个完整的 zlib 数据流 (pigz 的做法)
+
+        每个条带以上一条带末尾 32KB 作为预置字典，用 Z_SYNC_FLUSH 结束以按字节对齐，
+        最后一个条带用 Z_FINISH 结束；zlib 在压缩时会释放 GIL
+        """
+        workers = os.cpu_count() or 1
+        if multiprocessing.parent_process() is not None:
+            # 在进程池的工作进程中，其他工作进程已占用其余核心
+            workers = min(workers, settings.PNG_PARALLEL_DEFLATE_POOL_THREADS)
+        rows_per_strip = max(1, -(-height // (workers * 2)))
+        bounds = [
+            (y * stride, min(height, y + rows_per_strip) * stride)
+            for y in range(0, height, rows_per_strip)
+        ]
+        view = memoryview(raw_data)
+
+        def deflate_strip(index: int) -> bytes:
+            start, end = bounds[index]
+            if start > 0:
+                compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zdict=view[max(0, start - 32768):start])
+            else:
+                compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9)
+            last = index == len(bounds) - 1
+            return compressor.compress(view[start:end]) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(deflate_strip, range(len(bounds))))
+
+        adler = zlib.adler32(raw_data) & 0xffffffff
+        return b'\x78\xda' + b''.join(parts) + struct.pack('>I', adler)
 
-    def _write_chunk(self, output: io.BytesIO, chunk_type: bytes, data: bytes):
+    def _write_chunk(self, output: BinaryIO, chunk_type: bytes, data: bytes):
         """写入 PNG chunk"""
         output.write(struct.pack('>I', len(data)))
         output.write(chunk_type)
         output.write(data)
-        crc = zlib.crc32(chunk_type + data) & 0xffffffff
+        # 增量计算 CRC，避免为 chunk_type + data 拼接出一份完整拷贝
+        if HAS_ISAL:
+            crc = isal_zlib.crc32(data, isal_zlib.crc32(chunk_type)) & 0xffffffff
+        else:
+            crc = zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff
         output.write(struct.pack('>I', crc))
 
     def _compress_png_pillow(self, img: Image.Image, output_path: str, max_colors: int):
-        """Pillow PNG 压缩备用方案"""
+        """
+        Pillow PNG 压缩备用方案
+
+        量化后的调色板图片不加 optimize：对其体积无影响，只多一次扫描
+        """
         try:
             has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
 
             if has_alpha:
                 if img.mode != 'RGBA':
                     img = img.convert('RGBA')
-                img_q = img.quantize(colors=max_colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.FLOYDSTEINBERG)
-                img_q.convert('RGBA').save(output_path, 'PNG', optimize=True, compress_level=9)
+                img_q = self._pillow_quantize(img, max_colors)
+                # 量化结果的调色板已带透明度，直接保存为调色板 PNG，不再展开回 RGBA
+                img_q.save(output_path, 'PNG', compress_level=9)
             else:
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
-                img_q = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=max_colors)
-                img_q.save(output_path, 'PNG', optimize=True, compress_level=9)
+                if PILLOW_HAS_LIBIMAGEQUANT:
+                    img_q = self._pillow_quantize(img, max_colors)
+                else:
+                    img_q = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=max_colors)
+                img_q.save(output_path, 'PNG', compress_level=9)
         except Exception:
             img.save(output_path, 'PNG', optimize=True, compress_level=9)
 
-    def _compress_jpeg(self, img: Image.Image, output_path: str, quality: int):
-        """JPEG 压缩 - 使用 MozJPEG 优化"""
-
-        buffer = io.BytesIO()
-        img.save(
-            buffer,
-            'JPEG',
-            quality=quality,
-            optimize=True,
-            progressive=True,
-            subsampling='4:2:0'
-        )
+    def _pillow_quantize(self, img: Image.Image, max_colors: int) -> Image.Image:
+        """用 Pillow 量化为调色板图片，有 libimagequant 时优先使用"""
+        method = Image.Quantize.LIBIMAGEQUANT if PILLOW_HAS_LIBIMAGEQUANT else Image.Quantize.FASTOCTREE
+        # 不传 palette 时 Pillow 忽略 dither 参数：八叉树不抖动，libimagequant 固定使用自己的抖动
+        return img.quantize(colors=max_colors, method=method)
 
-        jpeg_bytes = buffer.getvalue()
+    def _compress_jpeg(self, img: Image.Image, output_path: str, quality: int, dynamic_quality: bool = False):
+        """JPEG 压缩 - 使用 MozJPEG 优化"""
 
+        if dynamic_quality:
+            jpeg_bytes = self._compress_jpeg_dynamic(img, quality)
+        else:
+            jpeg_bytes = self._encode_jpeg_cjpeg(img, quality)
+            if jpeg_bytes is not None:
+                with open(output_path, 'wb') as f:
+                    f.write(jpeg_bytes)
+                return
+            jpeg_bytes = self._encode_jpeg(img, quality)
 
         if HAS_MOZJPEG:
             try:
                 jpeg_bytes = mozjpeg_lossless_optimization.optimize(jpeg_bytes)
-                print(f"[JPEG压缩] MozJPEG 优化完成")
+                logger.debug("[JPEG压缩] MozJPEG 优化完成")
             except Exception as e:
-                print(f"[JPEG压缩] MozJPEG 优化失败: {e}")
+                logger.warning("[JPEG压缩] MozJPEG 优化失败: %s", e)
 
 
         with open(output_path, 'wb') as f:
             f.write(jpeg_bytes)
 
+    def _encode_jpeg(self, img: Image.Image, quality: int) -> bytes:
+        """编码 JPEG: 配置了 mozjpeg 版 libturbojpeg 时直接编码像素，否则用 Pillow"""
+        if HAS_TURBOJPEG and HAS_NUMPY and img.mode == 'RGB':
+            try:
+                return turbojpeg.encode(
+                    np.asarray(img),
+                    quality=quality,
+                    pixel_format=TJPF_RGB,
+                    jpeg_subsample=TJSAMP_420,
+                    flags=0 if HAS_MOZJPEG else TJFLAG_PROGRESSIVE
+                )
+            except Exception as e:
+                logger.warning("[JPEG压缩] turbojpeg 编码失败: %s，使用 Pillow", e)
+
+        with io.BytesIO() as buffer:
+            img.save(
+                buffer,
+                'JPEG',
+                quality=quality,
+                # MozJPEG 会重新优化 Huffman 表并生成渐进式扫描，不必让 Pillow 先做一遍
+                optimize=not HAS_MOZJPEG,
+                progressive=not HAS_MOZJPEG,
+                subsampling='4:2:0'
+            )
+            return buffer.getvalue()
+
+    def _encode_jpeg_cjpeg(self, img: Image.Image, quality: int) -> Optional[bytes]:
+        """
+        用 mozjpeg 的 cjpeg 编码 (trellis 量化 + 优化 Huffman 表 + 渐进式)
+
+        输出已是最优熵编码，不需要再做 MozJPEG 无损优化；不可用或失败时返回 None
+        """
+        if not has_mozjpeg_cjpeg() or img.mode != 'RGB':
+            return None
+
+        # 以 PPM 格式经 stdin 传入，不写临时文件
+        header = f"P6\n{img.width} {img.height}\n255\n".encode('ascii')
+        try:
+            result = subprocess.run(
+                [str(CJPEG_PATH), '-quality', str(quality), '-sample', '2x2'],
+                input=header + img.tobytes(),
+                capture_output=True,
+                timeout=60
+            )
+        except Exception as e:
+            logger.warning("[JPEG压缩] cjpeg 异常: %s", e)
+            return None
+
+        if result.returncode != 0 or not result.stdout:
+            logger.warning("[JPEG压缩] cjpeg 失败: %s", result.stderr.decode(errors='replace').strip())
+            return None
+        return result.stdout
+
+    def _compress_jpeg_dynamic(self, img: Image.Image, max_quality: int) -> bytes:
+        """
+        按图片内容选择 JPEG 质量
+
+        在 [max_quality - JPEG_DYNAMIC_QUALITY_RANGE, max_quality] 内二分查找，
+        取解码后与原图的 RMS 误差低于 JPEG_DYNAMIC_MAX_RMS 的最低质量；
+        都不满足时使用 max_quality
+        """
+        low = max(1, max_quality - settings.JPEG_DYNAMIC_QUALITY_RANGE)
+        high = max_quality
+        best = None
+
+        while low <= high:
+            quality = (low + high) // 2
+            jpeg_bytes = self._encode_jpeg(img, quality)
+            with Image.open(io.BytesIO(jpeg_bytes)) as decoded:
+                diff = ImageChops.difference(img, decoded.convert(img.mode))
+            rms = (sum(v * v for v in ImageStat.Stat(diff).rms) / len(diff.getbands())) ** 0.5
+
+            if rms < settings.JPEG_DYNAMIC_MAX_RMS:
+                best = jpeg_bytes
+                high = quality - 1
+            else:
+                low = quality + 1
+
+        if best is None:
+            best = self._encode_jpeg(img, max_quality)
+        return best
+
     def _compress_webp(self, img: Image.Image, output_path: str, quality: int):
         """WebP 压缩 - 使用 Google WebP 编码器"""
         img.save(
             output_path,
             'WEBP',
             quality=quality,
-            method=6, 
+            method=settings.WEBP_METHOD,
             lossless=False
         )
 
@@ -474,33 +1020,37 @@ class AdvancedCompressor:
             output_path,
             'AVIF',
             quality=quality,
-            speed=0 
+            speed=settings.AVIF_SPEED
         )
 
 
-    def get_optimal_format(self, input_path: str) -> str:
+    def get_optimal_format(self, input_path: Union[str, Image.Image]) -> str:
         """
         分析图片并返回最佳输出格式
 
         Args:
-            input_path: 输入文件路径
+            input_path: 输入文件路径，或已打开的图片 (之后可传给 compress_image 复用，避免重复解码)
 
         Returns:
             最佳格式 (AVIF/WebP/JPEG/PNG)
         """
+        if isinstance(input_path, Image.Image):
+            return self._optimal_format_for(input_path)
         with Image.open(input_path) as img:
+            return self._optimal_format_for(img)
 
-            has_alpha = img.mode in ['RGBA', 'LA', 'P'] and (
-                img.mode != 'P' or 'transparency' in img.info
-            )
+    def _optimal_format_for(self, img: Image.Image) -> str:
+        has_alpha = img.mode in ['RGBA', 'LA', 'P'] and (
+            img.mode != 'P' or 'transparency' in img.info
+        )
 
 
-            if has_alpha:
-                return 'AVIF'
-            if self._is_simple_image(img):
-                return 'PNG'
-            else:
-                return 'AVIF' 
+        if has_alpha:
+            return 'AVIF'
+        if self._is_simple_image(img):
+            return 'PNG'
+        else:
+            return 'AVIF' 
 
     def _is_simple_image(self, img: Image.Image) -> bool:
         """判断是否为简单图片（图标、logo等）"""
@@ -511,24 +1061,30 @@ class AdvancedCompressor:
 
         width, height = img.size
         if width * height < 100000: 
-            colors = len(set(list(img.getdata())))
-            return colors < 256
+            return self._has_few_colors(img, 256)
         else:
 
-            img_small = img.resize((100, 100), Image.Resampling.LANCZOS)
-            colors = len(set(list(img_small.getdata())))
-            return colors < 100
+            # 只用于统计颜色数，BOX 滤波比 LANCZOS 便宜得多，也不会因振铃产生额外的颜色
+            img_small = img.resize((100, 100), Image.Resampling.BOX)
+            return self._has_few_colors(img_small, 100)
+
+    def _has_few_colors(self, img: Image.Image, limit: int) -> bool:
+        """颜色数是否少于 limit - getcolors 在 C 中计数，超过上限立即返回 None"""
+        return img.getcolors(maxcolors=limit - 1) is not None
 
     def compress_in_memory(
         self,
         input_buffer: io.BytesIO,
         output_buffer: io.BytesIO,
         target_format: str,
-        quality: int = 85
+        quality: int = 85,
+        dynamic_quality: bool = False
     ) -> Tuple[int, float]:
         """
         内存中压缩图片
 
+        dynamic_quality 为 True 时，JPEG 按图片内容在 quality 以下查找更低的质量
+
         Returns:
             (压缩后大小, 压缩率)
         """
@@ -536,169 +1092,169 @@ class AdvancedCompressor:
         original_bytes = input_buffer.getvalue()
         original_size = len(original_bytes)
 
-        target_format = target_format.upper()
-        if target_format == 'JPG':
-            target_format = 'JPEG'
-
+        target_format = normalize_format(target_format)
 
-        if target_format == 'PNG' and (HAS_IMAGEQUANT or HAS_PNGQUANT):
-            success = self._compress_png_raw(original_bytes, output_buffer)
-            if success:
-                compressed_size = len(output_buffer.getvalue())
-                ratio = (1 - compressed_size / original_size) * 100 if original_size > 0 else 0
-                return compressed_size, ratio
 
+        passthrough = self._compress_same_format(original_bytes, input_buffer, target_format, quality)
+        if passthrough is not None:
+            output_buffer.write(passthrough)
+            compressed_size = len(passthrough)
+            ratio = (1 - compressed_size / original_size) * 100 if original_size > 0 else 0
+            return compressed_size, ratio
 
         input_buffer.seek(0)
         with Image.open(input_buffer) as img:
-
-            if target_format == 'JPEG' and img.mode in ['RGBA', 'LA', 'P']:
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                if img.mode in ['RGBA', 'LA']:
-                    background.paste(img, mask=img.split()[-1])
-                else:
-                    background.paste(img)
-                img = background
-            elif img.mode not in ['RGB', 'RGBA']:
-                img = img.convert('RGBA' if target_format in ['PNG', 'WEBP'] else 'RGB')
+            source_is_png = img.format == 'PNG'
+            img = self._normalize_mode(img, target_format)
 
 
             if target_format == 'PNG':
-                self._compress_png_memory(img, output_buffer, quality)
+                # 只解码一次：原图已是 PNG 时，pngquant 直接使用原始数据
+                self._compress_png_memory(img, output_buffer, quality, original_bytes if source_is_png else None)
             elif target_format == 'JPEG':
-                self._compress_jpeg_memory(img, output_buffer, quality)
+                self._compress_jpeg_memory(img, output_buffer, quality, dynamic_quality)
             elif target_format == 'WEBP':
-                img.save(output_buffer, 'WEBP', quality=quality, method=6)
+                img.save(output_buffer, 'WEBP', quality=quality, method=settings.WEBP_METHOD)
+            elif target_format == 'AVIF':
+                img.save(output_buffer, 'AVIF', quality=quality, speed=settings.AVIF_SPEED)
             else:
                 img.save(output_buffer, target_format, optimize=True)
 
-        compressed_size = len(output_buffer.getvalue())
+        compressed_size = output_buffer.getbuffer().nbytes
         ratio = (1 - compressed_size / original_size) * 100 if original_size > 0 else 0
 
         return compressed_size, ratio
 
-    def _compress_png_raw(self, png_bytes: bytes, output_buffer: io.BytesIO) -> bool:
-        """
-        PNG 压缩 - 优先使用 imagequant + zlib (与 wasm-image-compressor 相同算法)
+    def _compress_same_format(self, data: bytes, input_buffer: io.BytesIO, target_format: str, quality: int) -> Optional[bytes]:
         """
+        同格式输入的无损快速路径，不解码像素
 
-        if HAS_IMAGEQUANT:
-            try:
-                with Image.open(io.BytesIO(png_bytes)) as img:
-                    self._compress_png_imagequant(img, output_buffer, max_colors=254, fast_mode=False)
-                    compressor_name = "zopfli" if HAS_ZOPFLI else "zlib"
-                    print(f"[PNG压缩] imagequant + {compressor_name} 完成")
-                    return True
-            except Exception as e:
-                print(f"[PNG压缩] imagequant 失败: {e}")
-
-
-        if HAS_PNGQUANT:
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_in:
-                tmp_in_path = tmp_in.name
-                tmp_in.write(png_bytes)
-
-            tmp_out_path = tmp_in_path.replace('.png', '_out.png')
+        - JPEG 原图质量不高于目标质量: 只用 MozJPEG 无损重写
+        - 已是调色板的 PNG: 不再量化，只用 oxipng 无损优化
 
+        Returns:
+            优化后的数据，不适用时返回 None
+        """
+        source_format = sniff_format(data)
+
+        if source_format == 'jpeg' and target_format == 'JPEG' and HAS_MOZJPEG:
+            input_buffer.seek(0)
+            with Image.open(input_buffer) as img:
+                source_quality = self._estimate_jpeg_quality(img)
+            if source_quality is None or source_quality > quality:
+                return None
             try:
-                result = subprocess.run([
-                    str(PNGQUANT_PATH),
-                    '254',
-                    '--speed=3',
-                    '--strip',
-                    '--force',
-                    '--output', tmp_out_path,
-                    tmp_in_path
-                ], capture_output=True, timeout=60)
-
-                if result.returncode == 0 and os.path.exists(tmp_out_path):
-                    with open(tmp_out_path, 'rb') as f:
-                        output_buffer.write(f.read())
-                    print(f"[PNG压缩] pngquant 完成")
-                    return True
+                optimized = mozjpeg_lossless_optimization.optimize(data)
             except Exception as e:
-                print(f"[PNG压缩] pngquant 失败: {e}")
-            finally:
-                for path in [tmp_in_path, tmp_out_path]:
-                    try:
-                        os.unlink(path)
-                    except Exception:
-                        pass
-
-        return False
-
-    def _compress_png_memory(self, img: Image.Image, output_buffer: io.BytesIO, quality: int):
-        """PNG 内存压缩 - 优先使用 imagequant"""
+                logger.warning("[JPEG压缩] MozJPEG 无损优化失败: %s", e)
+                return None
+            return optimized if len(optimized) < len(data) else data
+
+        if source_format == 'png' and target_format == 'PNG' and has_oxipng():
+            # IHDR 的颜色类型字节，3 表示调色板
+            if len(data) > 25 and data[25] == 3:
+                optimized = self._oxipng_optimize_bytes(data)
+                return optimized if len(optimized) < len(data) else data
+
+        return None
+
+    def _estimate_jpeg_quality(self, img: Image.Image) -> Optional[int]:
+        """根据亮度量化表估算 JPEG 的 libjpeg 质量值，只读取文件头"""
+        tables = getattr(img, 'quantization', None)
+        if not tables or 0 not in tables:
+            return None
+
+        scale = sum(tables[0]) * 100 / STD_LUMINANCE_QUANT_SUM
+        if scale <= 100:
+            estimated = (200 - scale) / 2
+        else:
+            estimated = 5000 / scale
+        return max(1, min(100, round(estimated)))
 
+    def _compress_png_memory(self, img: Image.Image, output_buffer: io.BytesIO, quality: int, png_bytes: Optional[bytes] = None):
+        """
+        PNG 内存压缩 - 优先使用 imagequant + zopfli (与 wasm-image-compressor 相同算法)
 
+        Args:
+            png_bytes: 原始 PNG 数据，提供时直接交给 pngquant，不再重新编码
+        """
         if HAS_IMAGEQUANT:
+            start = output_buffer.tell()
             try:
-                self._compress_png_imagequant(img, output_buffer, max_colors=254, fast_mode=False)
-                print(f"[PNG压缩] imagequant 完成")
+                compressor_name = self._write_quantized_png(img, output_buffer)
+                logger.debug("[PNG压缩] imagequant + %s 完成", compressor_name)
                 return
             except Exception as e:
-                print(f"[PNG压缩] imagequant 失败: {e}")
+                # 直接写入 output_buffer，失败时丢弃已写入的部分，再交给后备方案
+                output_buffer.seek(start)
+                output_buffer.truncate()
+                logger.warning("[PNG压缩] imagequant 失败: %s", e)
 
 
-        if HAS_PNGQUANT:
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_in:
-                tmp_in_path = tmp_in.name
-                img.save(tmp_in_path, 'PNG')
-
-            tmp_out_path = tmp_in_path.replace('.png', '_out.png')
-
+        if has_pngquant():
             try:
-                result = subprocess.run([
-                    str(PNGQUANT_PATH),
-                    '254',
-                    '--speed=3',
-                    '--strip',
-                    '--force',
-                    '--output', tmp_out_path,
-                    tmp_in_path
-                ], capture_output=True, timeout=60)
-
-                if result.returncode == 0 and os.path.exists(tmp_out_path):
-                    with open(tmp_out_path, 'rb') as f:
-                        output_buffer.write(f.read())
+                quantized = self._run_pngquant(png_bytes if png_bytes is not None else self._encode_png(img), speed=3)
+                if quantized is not None:
+                    output_buffer.write(self._oxipng_post_pass(quantized))
+                    logger.debug("[PNG压缩] pngquant 完成")
                     return
-            except Exception:
-                pass
-            finally:
-                for path in [tmp_in_path, tmp_out_path]:
-                    try:
-                        os.unlink(path)
-                    except Exception:
-                        pass
+            except Exception as e:
+                logger.warning("[PNG压缩] pngquant 失败: %s", e)
 
 
         self._compress_png_pillow_memory(img, output_buffer, 254)
 
+    def _write_quantized_png(self, img: Image.Image, output: BinaryIO) -> str:
+        """
+        用 imagequant 量化并把 PNG 写入 output，返回最终压缩所用的工具名；文件和内存路径共用
+
+        有 oxipng 时结果会交给它重新压缩，中间结果只做快速压缩，不必先跑一遍 zopfli；
+        否则 chunk 直接写入 output，不在内存中先拼出完整的 PNG
+        """
+        if has_oxipng():
+            with io.BytesIO() as intermediate:
+                self._compress_png_imagequant(img, intermediate, max_colors=254, fast_mode=True)
+                output.write(self._oxipng_optimize_bytes(intermediate.getvalue()))
+            return "oxipng"
+
+        self._compress_png_imagequant(img, output, max_colors=254, fast_mode=False)
+        return "zopfli" if HAS_ZOPFLI else "zlib"
+
     def _compress_png_pillow_memory(self, img: Image.Image, output_buffer: io.BytesIO, max_colors: int):
-        """Pillow PNG 内存压缩备用"""
+        """
+        Pillow PNG 内存压缩备用
+
+        量化后的调色板图片不加 optimize：对其体积无影响，只多一次扫描
+        """
         try:
             has_alpha = img.mode in ('RGBA', 'LA')
             if has_alpha:
                 if img.mode != 'RGBA':
                     img = img.convert('RGBA')
-                img_q = img.quantize(colors=max_colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.FLOYDSTEINBERG)
-                img_q.convert('RGBA').save(output_buffer, 'PNG', optimize=True, compress_level=9)
+                img_q = self._pillow_quantize(img, max_colors)
+                # 量化结果的调色板已带透明度，直接保存为调色板 PNG，不再展开回 RGBA
+                img_q.save(output_buffer, 'PNG', compress_level=9)
             else:
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
-                img_q = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=max_colors)
-                img_q.save(output_buffer, 'PNG', optimize=True, compress_level=9)
+                if PILLOW_HAS_LIBIMAGEQUANT:
+                    img_q = self._pillow_quantize(img, max_colors)
+                else:
+                    img_q = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=max_colors)
+                img_q.save(output_buffer, 'PNG', compress_level=9)
         except:
             img.save(output_buffer, 'PNG', optimize=True, compress_level=9)
 
-    def _compress_jpeg_memory(self, img: Image.Image, output_buffer: io.BytesIO, quality: int):
+    def _compress_jpeg_memory(self, img: Image.Image, output_buffer: io.BytesIO, quality: int, dynamic_quality: bool = False):
         """JPEG 内存压缩 - 使用 MozJPEG 优化"""
-        temp_buffer = io.BytesIO()
-        img.save(temp_buffer, 'JPEG', quality=quality, optimize=True, progressive=True, subsampling='4:2:0')
-
-        jpeg_bytes = temp_buffer.getvalue()
+        if dynamic_quality:
+            jpeg_bytes = self._compress_jpeg_dynamic(img, quality)
+        else:
+            jpeg_bytes = self._encode_jpeg_cjpeg(img, quality)
+            if jpeg_bytes is not None:
+                output_buffer.write(jpeg_bytes)
+                return
+            jpeg_bytes = self._encode_jpeg(img, quality)
 
         if HAS_MOZJPEG:
             try:
@@ -713,49 +1269,159 @@ class AdvancedCompressor:
         input_files: list,
         output_dir: str,
         quality: int = 85,
-        output_format: Optional[str] = None
+        output_format: Optional[str] = None,
+        max_workers: Optional[int] = None
     ) -> list:
         """
         批量压缩图片
 
         Args:
-            input_files: 输入文件列表
+            input_files: 输入文件列表，或输入目录 (处理其中支持格式的文件)
             output_dir: 输出目录
             quality: 压缩质量
             output_format: 输出格式
+            max_workers: 最大并行数 (None=CPU 核心数，最多 32)
 
         Returns:
             压缩结果列表
         """
-        results = []
+        # 传入目录时用 scandir 一次取得文件大小，后续不再逐个 stat
+        sizes = {}
+        if isinstance(input_files, (str, os.PathLike)) and os.path.isdir(input_files):
+            with os.scandir(input_files) as entries:
+                for entry in entries:
+                    if entry.is_file() and Path(entry.name).suffix.lower() in settings.ALLOWED_EXTENSIONS:
+                        sizes[entry.path] = entry.stat().st_size
+            input_files = sorted(sizes)
+
         os.makedirs(output_dir, exist_ok=True)
+        workers = max_workers or min(32, os.cpu_count() or 1)
+
+        # 没有 imagequant 时，PNG -> PNG 的文件交给 pngquant 批量处理，
+        # 一次调用处理多个文件，摊薄进程启动开销；有 imagequant 时在进程内量化，无需启动子进程
+        png_files = []
+        if not HAS_IMAGEQUANT and has_pngquant() and (output_format or 'PNG').upper() == 'PNG':
+            png_files = [f for f in input_files if Path(f).suffix.lower() == '.png']
+
+        # pngquant 在子进程中运行，线程即可并行
+        done = {}
+        groups = [png_files[i::workers] for i in range(min(workers, len(png_files)))]
+        if groups:
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                for group_results in executor.map(lambda group: self._batch_pngquant(group, output_dir, sizes), groups):
+                    done.update(group_results)
+
+        # 其余文件以及 pngquant 未处理成功的文件逐个压缩；
+        # zopfli 等在 Python 线程中运行的 CPU 密集步骤需要多进程才能用满所有核心
+        remaining = [f for f in input_files if f not in done]
+        if remaining:
+            compress_one = functools.partial(
+                self._batch_compress_one,
+                output_dir=output_dir,
+                quality=quality,
+                output_format=output_format
+            )
+            remaining_sizes = [sizes.get(f) for f in remaining]
+            with ProcessPoolExecutor(max_workers=min(workers, len(remaining)), mp_context=process_pool_context()) as executor:
+                for input_file, result in zip(remaining, executor.map(compress_one, remaining, remaining_sizes)):
+                    done[input_file] = result
+
+        return [done[f] for f in input_files]
+
+    def _batch_pngquant(self, input_files: list, output_dir: str, sizes: Optional[dict] = None) -> dict:
+        """
+        用一次 pngquant 调用压缩多个 PNG 文件
 
+        先把原图复制到输出目录，再让 pngquant 原地覆盖；
+        pngquant 对质量不达标的文件不会写入，这些文件不出现在返回结果中，由调用方回退；
+        sizes 为已知的 {输入文件: 大小}
+
+        Returns:
+            {输入文件: 结果}
+        """
+        copies = {}
         for input_file in input_files:
+            output_file = os.path.join(output_dir, f"{Path(input_file).stem}.png")
             try:
-                filename = Path(input_file).stem
-                ext = output_format.lower() if output_format else Path(input_file).suffix[1:]
-                output_file = os.path.join(output_dir, f"{filename}.{ext}")
-
-                original_size, compressed_size, ratio = self.compress_image(
-                    input_file,
-                    output_file,
-                    quality,
-                    output_format
-                )
+                shutil.copyfile(input_file, output_file)
+            except Exception:
+                continue
+            copies[input_file] = output_file
 
-                results.append({
-                    'filename': Path(input_file).name,
-                    'original_size': original_size,
-                    'compressed_size': compressed_size,
-                    'compression_ratio': ratio,
-                    'output_path': output_file,
-                    'success': True
-                })
-            except Exception as e:
-                results.append({
-                    'filename': Path(input_file).name,
-                    'error': str(e),
-                    'success': False
-                })
+        if not copies:
+            return {}
 
+        try:
+            result = subprocess.run([
+                str(PNGQUANT_PATH),
+                '254',
+                '--speed=1',
+                '--strip',
+                '--force',
+                '--ext', '.png',
+                *copies.values()
+            ], capture_output=True, timeout=60 * len(copies))
+        except Exception as e:
+            logger.warning("[PNG压缩] pngquant 批量压缩失败: %s", e)
+            return {}
+
+        # 98/99 只表示部分文件保留原图，其余文件仍已压缩；其他非零退出码说明输出不可信，全部回退
+        if result.returncode != 0 and result.returncode not in PNGQUANT_SKIP_CODES:
+            logger.warning("[PNG压缩] pngquant 批量压缩返回 code=%s，回退逐个压缩", result.returncode)
+            return {}
+
+        results = {}
+        for input_file, output_file in copies.items():
+            original_size = (sizes or {}).get(input_file)
+            if original_size is None:
+                original_size = os.path.getsize(input_file)
+            compressed_size = os.path.getsize(output_file)
+            if compressed_size == original_size:
+                continue
+
+            results[input_file] = {
+                'filename': Path(input_file).name,
+                'original_size': original_size,
+                'compressed_size': compressed_size,
+                'compression_ratio': (1 - compressed_size / original_size) * 100,
+                'output_path': output_file,
+                'success': True
+            }
         return results
+
+    def _batch_compress_one(
+        self,
+        input_file: str,
+        original_size: Optional[int],
+        output_dir: str,
+        quality: int,
+        output_format: Optional[str]
+    ) -> dict:
+        """压缩批量任务中的单个文件，失败时返回错误信息"""
+        try:
+            filename = Path(input_file).stem
+            ext = output_format.lower() if output_format else Path(input_file).suffix[1:]
+            output_file = os.path.join(output_dir, f"{filename}.{ext}")
+
+            original_size, compressed_size, ratio = self.compress_image(
+                input_file,
+                output_file,
+                quality,
+                output_format,
+                original_size=original_size
+            )
+
+            return {
+                'filename': Path(input_file).name,
+                'original_size': original_size,
+                'compressed_size': compressed_size,
+                'compression_ratio': ratio,
+                'output_path': output_file,
+                'success': True
+            }
+        except Exception as e:
+            return {
+                'filename': Path(input_file).name,
+                'error': str(e),
+                'success': False
+            }
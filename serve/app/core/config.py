@@ -1,13 +1,32 @@
 """
 应用配置
 """
-from typing import List
+from typing import FrozenSet
 
 
 class Settings:
     MAX_FILE_SIZE: int = 10 * 1024 * 1024 
     MAX_FILES_PER_BATCH: int = 20
-    ALLOWED_EXTENSIONS: List[str] = ['.jpg', '.jpeg', '.png', '.webp']
+    MAX_CONCURRENT_READS: int = 8
+    # 微批处理: 单批最多合并的图片数，以及凑批的最长等待时间
+    MAX_BATCH_SIZE: int = 16
+    MAX_LATENCY_MS: int = 10
+    ALLOWED_EXTENSIONS: FrozenSet[str] = frozenset({'.jpg', '.jpeg', '.png', '.webp', '.avif'})
+    # 结果缓存只在主进程中保存一份，所有工作进程共用这一容量
+    RESULT_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    # WebP 编码 method (0-6): 越大越慢、体积略小，6 比 4 慢数倍但通常只小 1-2%
+    WEBP_METHOD: int = 4
+    # AVIF 编码 speed (0-10): 越小越慢，0 对大图可能需要数分钟
+    AVIF_SPEED: int = 6
+    # 超过该像素数的 PNG 在最佳压缩时改为多线程分条带 DEFLATE
+    PNG_PARALLEL_DEFLATE_PIXELS: int = 4_000_000
+    # 进程池的工作进程已各占一个核心，在其中分条带压缩时最多只开这么多线程
+    PNG_PARALLEL_DEFLATE_POOL_THREADS: int = 2
+    # JPEG 动态质量: 在 [quality - 范围, quality] 内二分查找，取解码后 RMS 误差低于阈值的最低质量
+    JPEG_DYNAMIC_QUALITY_RANGE: int = 15
+    JPEG_DYNAMIC_MAX_RMS: float = 3.0
+    # pngquant 结果超过该字节数时再用 oxipng 重新压缩
+    OXIPNG_MIN_BYTES: int = 50 * 1024
 
 
 settings = Settings()
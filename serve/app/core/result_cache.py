@@ -0,0 +1,69 @@
+"""
+压缩结果缓存
+按内容哈希缓存压缩结果，重复上传同一张图片时直接返回，跳过重新压缩
+只在主进程中由 batcher 查找和写入，命中时图片不必再发往工作进程
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from app.core.config import settings
+
+try:
+    import blake3
+    HAS_BLAKE3 = True
+except ImportError:
+    HAS_BLAKE3 = False
+
+
+def content_digest(content: bytes) -> bytes:
+    """计算内容哈希，优先使用 BLAKE3，未安装时退回 BLAKE2b"""
+    if HAS_BLAKE3:
+        return blake3.blake3(content).digest()
+    return hashlib.blake2b(content, digest_size=32).digest()
+
+
+class ResultCache:
+    """
+    线程安全的 LRU 缓存，按缓存数据的总字节数限制容量
+
+    值为 (压缩后数据, 压缩率)
+    """
+
+    def __init__(self, max_bytes: int = settings.RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, Tuple[bytes, float]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[Tuple[bytes, float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, data: bytes, ratio: float) -> None:
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+
+            self._entries[key] = (data, ratio)
+            self._size += len(data)
+
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+result_cache = ResultCache()
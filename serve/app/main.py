@@ -1,21 +1,37 @@
 """
 图片压缩服务 - FastAPI
 """
+import logging
 import os
+from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import HTMLResponse
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from app.core.config import settings
 from app.api import compress
+from app.core import batcher
+
+# 压缩过程的逐张日志为 DEBUG 级别，默认只输出警告
+logging.basicConfig(level=logging.WARNING)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # 退出时关闭压缩进程池，回收工作进程
+    batcher.batcher.shutdown()
+
 
 app = FastAPI(
     title="图片压缩服务",
     version="1.0.0",
     docs_url="/api/docs",
-    redoc_url="/api/redoc"
+    redoc_url="/api/redoc",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -34,6 +50,21 @@ async def health_check():
     return {"status": "ok"}
 
 
+class SPAStaticFiles(StaticFiles):
+    """前端静态文件，找不到的路径回退到 index.html (前端路由)，api 路径仍返回 404"""
+
+    async def get_response(self, path: str, scope):
+        try:
+            return await super().get_response(path, scope)
+        except StarletteHTTPException as e:
+            # 缺失的静态资源 (带扩展名) 仍返回 404，不回退到 index.html
+            if e.status_code != 404 or "." in path.rsplit("/", 1)[-1]:
+                raise
+        if path.startswith("api"):
+            return HTMLResponse(content='{"error": "not found"}', status_code=404)
+        return await super().get_response("index.html", scope)
+
+
 STATIC_DIR = None
 possible_paths = [
     Path(__file__).parent.parent / "static",
@@ -48,28 +79,8 @@ for p in possible_paths:
 
 if STATIC_DIR:
     
-    app.mount("/assets", StaticFiles(directory=STATIC_DIR / "assets"), name="assets")
-
-    @app.get("/favicon.ico")
-    async def favicon():
-        favicon_path = STATIC_DIR / "favicon.ico"
-        if favicon_path.exists():
-            return FileResponse(favicon_path)
-        return HTMLResponse(status_code=404)
-
-    @app.get("/vite.svg")
-    async def vite_svg():
-        svg_path = STATIC_DIR / "vite.svg"
-        if svg_path.exists():
-            return FileResponse(svg_path)
-        return HTMLResponse(status_code=404)
-
-    @app.get("/{full_path:path}")
-    async def serve_spa(request: Request, full_path: str):
-    
-        if full_path.startswith("api"):
-            return HTMLResponse(content='{"error": "not found"}', status_code=404)
-        return FileResponse(STATIC_DIR / "index.html")
+    # API 路由先于挂载匹配；静态文件由 StaticFiles 直接发送，不再逐个经过 Python 路由处理
+    app.mount("/", SPAStaticFiles(directory=STATIC_DIR, html=True), name="spa")
 
 else:
     print("[静态文件] 未找到静态目录，仅提供 API")
@@ -0,0 +1,79 @@
+"""
+微批处理器回归测试
+运行: python -m unittest discover tests (在 serve 目录下)
+"""
+import asyncio
+import io
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from PIL import Image
+
+from app.core.batcher import MicroBatcher, _compress_many, create_pool
+from app.core.result_cache import result_cache
+
+
+def _small_png(width: int = 256) -> bytes:
+    """不同宽度得到不同内容，避免命中结果缓存"""
+    buf = io.BytesIO()
+    Image.linear_gradient('L').convert('RGB').resize((width, 256)).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class BrokenPoolTest(unittest.TestCase):
+    """工作进程被杀后只有在途批次失败，之后的请求换用新的进程池"""
+
+    def test_recovers_after_worker_killed(self):
+        batcher = MicroBatcher(create_pool, workers=1, max_latency_ms=0)
+
+        async def scenario():
+            await batcher.submit(_small_png(200), 'png')
+            broken = batcher.pool
+            for process in list(broken._processes.values()):
+                process.kill()
+            # 等进程池的管理线程发现工作进程退出
+            deadline = time.monotonic() + 10
+            while not broken._broken and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+            with self.assertRaises(BrokenProcessPool):
+                await batcher.submit(_small_png(210), 'png')
+            self.assertIsNot(batcher.pool, broken)
+
+            compressed, compressed_size, _ = await batcher.submit(_small_png(220), 'png')
+            self.assertEqual(len(compressed), compressed_size)
+
+        try:
+            asyncio.run(scenario())
+        finally:
+            batcher.shutdown()
+
+
+class ResultCacheTest(unittest.TestCase):
+    """重复提交同一张图片时在主进程中命中缓存，不再发往进程池"""
+
+    def test_repeat_hits_cache(self):
+        content = _small_png()
+        result_cache.clear()
+        # 线程池在本进程中执行 _compress_many，便于统计调用次数
+        batcher = MicroBatcher(lambda: ThreadPoolExecutor(max_workers=1), workers=1, max_latency_ms=0)
+
+        async def scenario():
+            return await batcher.submit(content, 'png'), await batcher.submit(content, 'PNG')
+
+        try:
+            with mock.patch('app.core.batcher._compress_many', wraps=_compress_many) as compress_many:
+                first, second = asyncio.run(scenario())
+        finally:
+            batcher.shutdown()
+            result_cache.clear()
+
+        self.assertEqual(first, second)
+        self.assertEqual(compress_many.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+"""
+压缩器回归测试
+运行: python -m unittest discover tests (在 serve 目录下)
+"""
+import io
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+import numpy as np
+from PIL import Image, features
+
+from app.core.compressor import AdvancedCompressor, HAS_IMAGEQUANT, sniff_format
+from app.core.config import settings
+
+
+def _large_png() -> bytes:
+    """超过 PNG_PARALLEL_DEFLATE_PIXELS 的带噪声渐变图"""
+    side = int(settings.PNG_PARALLEL_DEFLATE_PIXELS ** 0.5) + 100
+    y, x = np.mgrid[0:side, 0:side]
+    base = np.dstack([x * 255 // side, y * 255 // side, np.full((side, side), 128)])
+    noise = np.random.default_rng(0).integers(-4, 5, base.shape)
+    img = Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+@unittest.skipUnless(HAS_IMAGEQUANT, "imagequant 未安装")
+class LargePngTest(unittest.TestCase):
+    """大于 4MP 的 PNG 仍应被量化为更小的调色板 PNG"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = _large_png()
+        cls.compressor = AdvancedCompressor()
+
+    def test_in_memory(self):
+        output = io.BytesIO()
+        compressed_size, ratio = self.compressor.compress_in_memory(io.BytesIO(self.data), output, 'png')
+
+        self.assertLess(compressed_size, len(self.data))
+        self.assertGreater(ratio, 0)
+        with Image.open(io.BytesIO(output.getvalue())) as img:
+            self.assertEqual(img.mode, 'P')
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, 'large.png')
+            output_path = os.path.join(tmp, 'large_out.png')
+            with open(input_path, 'wb') as f:
+                f.write(self.data)
+
+            original_size, compressed_size, _ = self.compressor.compress_image(input_path, output_path)
+
+            self.assertLess(compressed_size, original_size)
+            with Image.open(output_path) as img:
+                self.assertEqual(img.mode, 'P')
+
+
+class WritePngTest(unittest.TestCase):
+    """手工构建的调色板 PNG 解码后应与输入的索引像素一致"""
+
+    def _roundtrip(self, width: int, height: int, fast_mode: bool):
+        rng = np.random.default_rng(1)
+        # 成片的色块加少量噪声，接近量化结果
+        pixels = (np.add.outer(np.arange(height) // 37, np.arange(width) // 53) % 16).astype(np.uint8)
+        pixels[rng.random((height, width)) < 0.01] = 17
+        palette = bytes(rng.integers(0, 256, 18 * 4, dtype=np.uint8))
+
+        output = io.BytesIO()
+        AdvancedCompressor()._write_png(output, width, height, palette, pixels.tobytes(), fast_mode)
+
+        with Image.open(io.BytesIO(output.getvalue())) as img:
+            self.assertEqual(img.mode, 'P')
+            self.assertEqual(img.tobytes(), pixels.tobytes())
+
+    def test_large_fast(self):
+        side = int(settings.PNG_PARALLEL_DEFLATE_PIXELS ** 0.5) + 100
+        self._roundtrip(side, side, fast_mode=True)
+
+    def test_large_strips(self):
+        side = int(settings.PNG_PARALLEL_DEFLATE_PIXELS ** 0.5) + 100
+        self._roundtrip(side, side, fast_mode=False)
+
+
+def _scanline_filter_types(png_data: bytes, width: int) -> set:
+    """解压 IDAT，返回各行使用的过滤类型"""
+    pos, idat = 8, b''
+    while pos < len(png_data):
+        length, chunk_type = struct.unpack('>I4s', png_data[pos:pos + 8])
+        if chunk_type == b'IDAT':
+            idat += png_data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+    raw = zlib.decompress(idat)
+    return set(raw[::width + 1])
+
+
+@unittest.skipUnless(HAS_IMAGEQUANT, "imagequant 未安装")
+class ScanlineFilterTest(unittest.TestCase):
+    """最佳压缩模式下自适应过滤得到的 PNG，解码后应与不过滤时的像素完全一致"""
+
+    def _compress(self, input_path: str, output_path: str) -> bytes:
+        # 没有 oxipng 时 compress_image 才会用 zopfli 最佳压缩，经过 _choose_scanline_filters
+        with mock.patch('app.core.compressor.has_oxipng', return_value=False):
+            AdvancedCompressor().compress_image(input_path, output_path)
+        with open(output_path, 'rb') as f:
+            return f.read()
+
+    def test_filtered_matches_unfiltered(self):
+        # 灰度渐变上 Sub/Up 过滤比不过滤更小，会被采用
+        y, x = np.mgrid[0:96, 0:128]
+        gray = ((x + y) * 255 // 222).astype(np.uint8)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, 'gradient.png')
+            Image.fromarray(np.dstack([gray] * 3)).save(input_path)
+
+            filtered = self._compress(input_path, os.path.join(tmp, 'filtered.png'))
+            with mock.patch.object(AdvancedCompressor, '_choose_scanline_filters', side_effect=lambda raw, *args: raw):
+                unfiltered = self._compress(input_path, os.path.join(tmp, 'unfiltered.png'))
+
+        self.assertNotEqual(_scanline_filter_types(filtered, 128), {0})
+        self.assertEqual(_scanline_filter_types(unfiltered, 128), {0})
+        with Image.open(io.BytesIO(filtered)) as a, Image.open(io.BytesIO(unfiltered)) as b:
+            self.assertEqual(a.mode, 'P')
+            self.assertEqual(a.getpalette(), b.getpalette())
+            self.assertEqual(a.tobytes(), b.tobytes())
+
+
+def _ftyp(major: bytes, *compatible: bytes) -> bytes:
+    """构造 ftyp box，后面接一个空的 meta box"""
+    body = major + b'\x00\x00\x00\x00' + b''.join(compatible)
+    return struct.pack('>I', 8 + len(body)) + b'ftyp' + body + struct.pack('>I', 8) + b'meta'
+
+
+class SniffFormatTest(unittest.TestCase):
+    """AVIF 按 ftyp 的主品牌和兼容品牌识别"""
+
+    def test_major_brand(self):
+        self.assertEqual(sniff_format(_ftyp(b'avif', b'mif1', b'miaf')), 'avif')
+
+    def test_compatible_brand(self):
+        self.assertEqual(sniff_format(_ftyp(b'mif1', b'mif1', b'miaf', b'avif')), 'avif')
+
+    def test_heic_not_avif(self):
+        self.assertIsNone(sniff_format(_ftyp(b'mif1', b'mif1', b'heic')))
+
+    def test_brand_outside_box_ignored(self):
+        # ftyp box 之后的数据不属于兼容品牌
+        data = _ftyp(b'mif1', b'miaf')
+        self.assertIsNone(sniff_format(data + b'avif'))
+
+    @unittest.skipUnless(features.check('avif'), "Pillow 未启用 AVIF")
+    def test_pillow_output(self):
+        buf = io.BytesIO()
+        Image.new('RGB', (16, 16)).save(buf, 'AVIF')
+        self.assertEqual(sniff_format(buf.getvalue()), 'avif')
+
+
+@unittest.skipUnless(features.check('avif'), "Pillow 未启用 AVIF")
+class AvifAlphaTest(unittest.TestCase):
+    """带透明通道的非 RGBA 图片转 AVIF 时应保留透明通道"""
+
+    def test_la_keeps_alpha(self):
+        buf = io.BytesIO()
+        Image.new('LA', (64, 64), (128, 0)).save(buf, 'PNG')
+        output = io.BytesIO()
+        AdvancedCompressor().compress_in_memory(io.BytesIO(buf.getvalue()), output, 'avif', 80)
+
+        with Image.open(io.BytesIO(output.getvalue())) as img:
+            self.assertEqual(img.mode, 'RGBA')
+
+
+if __name__ == '__main__':
+    unittest.main()